@@ -6,7 +6,12 @@ import json
 from datetime import datetime
 from pathlib import Path
 
+import fcntl
+import gzip
+import zlib
+
 import requests
+import urllib3
 import tarfile
 import shutil
 import os
@@ -27,41 +32,46 @@ DATA_DIR = Path(os.getenv('ALERTAS_DIR') or str(DEFAULT_ALERTAS))
 # Para habilitarlos exporta `ALERTAS_DEBUG=1` en el entorno del contenedor.
 WRITE_DEBUG = os.getenv('ALERTAS_DEBUG', '0') in ('1', 'true', 'True')
 
-# Lock file to avoid concurrent runs (helps si el contenedor se lanza varias veces)
+# Lock para que no haya dos descargas a la vez (helps si el contenedor se lanza varias veces).
+# Solo protege la zona de descarga raw; lectores y re-parseos no lo necesitan (ver generations.py).
+# flock se libera solo si el proceso muere, así que no hace falta heurística de lock caducado.
 LOCK_FILE = DATA_DIR / '.fetch_lock'
-LOCK_STALE_SECONDS = 1800  # considerar stale si tiene más de 30min
+_lock_fd = None
 
 def acquire_lock():
-    """Try to create a lock file atomically. Returns True if lock acquired, False otherwise."""
+    """Try to take the fetch lock without blocking. Returns True if lock acquired, False otherwise."""
+    global _lock_fd
     try:
         DATA_DIR.mkdir(parents=True, exist_ok=True)
-        # Use os.open with O_EXCL to ensure atomic creation
-        fd = os.open(str(LOCK_FILE), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        fd = os.open(str(LOCK_FILE), os.O_CREAT | os.O_WRONLY)
         try:
-            os.write(fd, f"pid:{os.getpid()}\n".encode('utf-8'))
-        finally:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
             os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f"pid:{os.getpid()}\n".encode('utf-8'))
+        _lock_fd = fd
         return True
-    except FileExistsError:
-        try:
-            mtime = LOCK_FILE.stat().st_mtime
-            if time.time() - mtime > LOCK_STALE_SECONDS:
-                try:
-                    LOCK_FILE.unlink()
-                except Exception:
-                    return False
-                # retry once
-                return acquire_lock()
-        except Exception:
-            pass
+    except OSError:
         return False
 
 def release_lock():
+    global _lock_fd
+    if _lock_fd is None:
+        return
     try:
-        if LOCK_FILE.exists():
-            LOCK_FILE.unlink()
-    except Exception:
+        fcntl.flock(_lock_fd, fcntl.LOCK_UN)
+        os.close(_lock_fd)
+    except OSError:
         pass
+    _lock_fd = None
+
+# Descarga del paquete: reintentos con reanudación (Range) y bloque adaptativo
+DOWNLOAD_RETRIES = int(os.getenv('ALERTAS_DOWNLOAD_RETRIES', '3'))
+DOWNLOAD_CHUNK_MIN = 64 * 1024
+DOWNLOAD_CHUNK_MAX = 4 * 1024 * 1024
+PART_MAX_AGE_SECONDS = 86400  # descartar descargas parciales de más de 1 día
 
 
 def ensure_data_dir():
@@ -74,7 +84,7 @@ def recent_download_exists(max_age_seconds=3600):
     patterns = ('aemet-response-', 'aemet-ultimoelaborado-', '')
     try:
         for entry in DATA_DIR.iterdir():
-            if not entry.is_file():
+            if not entry.is_file() or entry.suffix == '.part':
                 continue
             # considerar solo ficheros relevantes: json, tar, gz, zip
             if not entry.suffix.lower() in ('.json', '.tar', '.gz', '.zip') and 'aemet' not in entry.name:
@@ -96,195 +106,346 @@ def mask_key(key: str) -> str:
     return '***'
 
 
+def fetch_aemet_datos_url():
+    """Consulta los endpoints CAP de AEMET y devuelve la URL del paquete de alertas.
+
+    Guarda la respuesta JSON en DATA_DIR (solo se conserva la última) y
+    devuelve `(json_path, datos_url)`. Si no se pudo obtener la respuesta,
+    `json_path` es None; si la respuesta no trae URL válida, `datos_url` es None.
+    """
+    endpoints = [
+        f"{AEMET_BASE}/avisos_cap/activos/area/esp?api_key={AEMET_API_KEY}",
+        f"{AEMET_BASE}/avisos_cap/ultimoelaborado/area/esp?api_key={AEMET_API_KEY}"
+    ]
+
+    # Intentar descargar nuevo JSON
+    json_path = None
+    for idx, url in enumerate(endpoints, start=1):
+        try:
+            print(f"📡 Descargando JSON AEMET (opción {idx}): {url.replace(AEMET_API_KEY, mask_key(AEMET_API_KEY))}")
+            resp = requests.get(url, timeout=15)
+            if resp.status_code == 200:
+                data = resp.json()
+                if data.get('estado') and data.get('datos'):
+                    ts = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+                    out_file = DATA_DIR / f'aemet-response-{ts}.json'
+                    with open(out_file, 'w', encoding='utf-8') as f:
+                        json.dump(data, f, ensure_ascii=False, indent=2)
+                    print(f"✅ Guardado JSON en: {out_file}")
+
+                    # mantener únicamente el último JSON
+                    try:
+                        for f in DATA_DIR.glob('aemet-response-*.json'):
+                            if f.resolve() != out_file.resolve():
+                                try:
+                                    f.unlink()
+                                except Exception:
+                                    pass
+                    except Exception:
+                        pass
+
+                    json_path = out_file
+                    break
+                else:
+                    print('⚠️  Respuesta API sin campos esperados (estado/datos)')
+            else:
+                print(f'⚠️  HTTP {resp.status_code} al consultar {url}')
+        except requests.RequestException as e:
+            print(f'❌ Error petición: {e}')
+
+    if not json_path:
+        return None, None
+
+    with open(json_path, 'r', encoding='utf-8') as jf:
+        data = json.load(jf)
+
+    datos_url = data.get('datos')
+    if isinstance(datos_url, list):
+        datos_url = datos_url[0] if datos_url else None
+    return json_path, datos_url
+
+
 def fetch_json():
-    if not AEMET_API_KEY:
-        print('❌ AEMET_API_KEY no configurada. Exporta AEMET_API_KEY en el entorno.')
+    # Import diferido: `sources` y `pipeline` importan este módulo
+    from sources import configured_sources
+    from pipeline import run_pipeline
+
+    sources = configured_sources()
+    if not sources:
+        print('❌ No hay fuentes de avisos configuradas (revisa AEMET_API_KEY y ALERTAS_SOURCES).')
         return 1
 
-    # Asegurar carpeta y limpieza de debug/tmp antes de arrancar
     ensure_data_dir()
-    # evitar ejecuciones concurrentes
-    locked = acquire_lock()
-    if not locked:
-        print('⏳ Otra instancia en ejecución. Se omite esta ejecución.')
+
+    # Si ya hay una descarga reciente (JSON O tar.gz dentro de la última hora), omitir
+    if recent_download_exists(max_age_seconds=3600):
+        print('⏱️  Descarga reciente encontrada, omitiendo sincronización')
         return 0
-    try:
-        clean_debug_and_tmp()
 
-        # Si ya hay una descarga reciente (JSON O tar.gz dentro de la última hora), omitir
-        if recent_download_exists(max_age_seconds=3600):
-            print('⏱️  Descarga reciente encontrada, omitiendo sincronización')
-            return 0
+    # fetch -> extract (con lock) -> parse -> publish -> notify en una generación nueva (ver pipeline.py);
+    # las etapas sin cambios se omiten
+    return run_pipeline(sources)
+
+
+def _write_debug_headers(status, headers):
+    """Guarda las cabeceras HTTP en `data/alertas/debug` si ALERTAS_DEBUG está activo."""
+    if not WRITE_DEBUG:
+        return None
+    ts = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    debug_dir = DATA_DIR / 'debug'
+    debug_dir.mkdir(parents=True, exist_ok=True)
+    headers_file = debug_dir / f'headers-{ts}.txt'
+    with open(headers_file, 'a', encoding='utf-8') as hf:
+        hf.write(f'STATUS: {status}\n')
+        for k, v in headers.items():
+            hf.write(f'{k}: {v}\n')
+    return headers_file
+
+
+def _expected_size(r, offset: int):
+    """Tamaño total esperado del fichero según Content-Range / Content-Length (o None)."""
+    m = re.match(r'bytes\s+\d+-\d+/(\d+)', r.headers.get('Content-Range', ''))
+    if m:
+        return int(m.group(1))
+    length = r.headers.get('Content-Length')
+    if length and length.isdigit():
+        return offset + int(length)
+    return None
+
+
+def _validator_path(part_path: Path) -> Path:
+    """Fichero junto al `.part` con el ETag/Last-Modified del recurso que se está descargando."""
+    return part_path.with_name(part_path.name[:-len('.part')] + '.validator.part')
+
+
+def _discard_part(part_path: Path):
+    for f in (part_path, _validator_path(part_path)):
+        try:
+            f.unlink()
+        except FileNotFoundError:
+            pass
 
-        endpoints = [
-            f"{AEMET_BASE}/avisos_cap/activos/area/esp?api_key={AEMET_API_KEY}",
-            f"{AEMET_BASE}/avisos_cap/ultimoelaborado/area/esp?api_key={AEMET_API_KEY}"
-        ]
 
-        # Intentar descargar nuevo JSON
-        json_path = None
-        for idx, url in enumerate(endpoints, start=1):
+def clean_stale_parts(keep: Path = None, out_dir: Path = None):
+    """Elimina descargas parciales (`*.part`) antiguas que ya no se van a reanudar."""
+    now = time.time()
+    kept = {keep.resolve(), _validator_path(keep).resolve()} if keep is not None else set()
+    try:
+        for f in (out_dir or DATA_DIR).glob('*.part'):
+            if f.resolve() in kept:
+                continue
             try:
-                print(f"📡 Descargando JSON AEMET (opción {idx}): {url.replace(AEMET_API_KEY, mask_key(AEMET_API_KEY))}")
-                resp = requests.get(url, timeout=15)
-                if resp.status_code == 200:
-                    data = resp.json()
-                    if data.get('estado') and data.get('datos'):
-                        ts = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-                        out_file = DATA_DIR / f'aemet-response-{ts}.json'
-                        with open(out_file, 'w', encoding='utf-8') as f:
-                            json.dump(data, f, ensure_ascii=False, indent=2)
-                        print(f"✅ Guardado JSON en: {out_file}")
-
-                        # mantener únicamente el último JSON
-                        try:
-                            for f in DATA_DIR.glob('aemet-response-*.json'):
-                                if f.resolve() != out_file.resolve():
-                                    try:
-                                        f.unlink()
-                                    except Exception:
-                                        pass
-                        except Exception:
-                            pass
-
-                        json_path = out_file
-                        break
-                    else:
-                        print('⚠️  Respuesta API sin campos esperados (estado/datos)')
-                else:
-                    print(f'⚠️  HTTP {resp.status_code} al consultar {url}')
-            except requests.RequestException as e:
-                print(f'❌ Error petición: {e}')
+                if now - f.stat().st_mtime > PART_MAX_AGE_SECONDS:
+                    f.unlink()
+            except Exception:
+                pass
+    except Exception:
+        pass
 
-        if not json_path:
-            print('❌ No se pudo obtener el JSON de AEMET (todas las opciones fallaron)')
-            return 2
 
-        # Intentar descargar el tar.gz indicado en el campo 'datos' del JSON seleccionado
+def _stream_to_part(url: str, part_path: Path, restarted: bool = False):
+    """Descarga (o reanuda con Range) `url` en `part_path`.
+
+    Devuelve el tamaño total esperado (o None si el servidor no lo indica).
+    Lanza `requests.RequestException` si falla la conexión y `ValueError` si el
+    servidor responde con un estado no válido. Si hay que descartar el `.part`
+    se reintenta desde el inicio una sola vez (`restarted`).
+    """
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    validator_path = _validator_path(part_path)
+    validator = validator_path.read_text(encoding='utf-8').strip() if validator_path.exists() else ''
+    if offset and not validator:
+        # Sin ETag/Last-Modified no se puede comprobar que el .part sea del mismo recurso
+        print('⚠️  Descarga parcial sin validador, se descarga desde el inicio')
+        _discard_part(part_path)
+        offset = 0
+    # identity: los offsets de Range deben referirse a los bytes del fichero, no a una codificación de transporte
+    headers = {'Accept-Encoding': 'identity'}
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+        # If-Range: si el recurso ha cambiado el servidor responde 200 con el fichero completo
+        headers['If-Range'] = validator
+
+    with requests.get(url, stream=True, timeout=60, allow_redirects=True, headers=headers) as r:
+        status = r.status_code
+        headers_file = _write_debug_headers(status, r.headers)
+
+        if status == 416 and offset:
+            # Rango no satisfacible: el .part ya tiene todo el fichero (o no corresponde a este recurso)
+            m = re.match(r'bytes\s+\*/(\d+)', r.headers.get('Content-Range', ''))
+            if m and int(m.group(1)) == offset:
+                return offset
+            _discard_part(part_path)
+            if restarted:
+                raise ValueError(f"rango no satisfacible ({r.headers.get('Content-Range')!r}) sin reanudar")
+            print('⚠️  Descarga parcial no válida para este recurso, se descarga desde el inicio')
+            return _stream_to_part(url, part_path, restarted=True)
+        if status not in (200, 206):
+            if headers_file:
+                raise ValueError(f'HTTP {status}. Headers guardadas en: {headers_file}')
+            raise ValueError(f'HTTP {status}')
+
+        # Si el servidor aplica igualmente una codificación de transporte, se decodifica
+        # y no se puede comparar con Content-Length ni reanudar por offset
+        encoded = r.headers.get('Content-Encoding', 'identity').lower() not in ('', 'identity')
+        if status == 206:
+            m = re.match(r'bytes\s+(\d+)-', r.headers.get('Content-Range', ''))
+            if encoded or not offset or not m or int(m.group(1)) != offset:
+                _discard_part(part_path)
+                if restarted:
+                    raise ValueError(f"respuesta 206 inesperada ({r.headers.get('Content-Range')!r}, esperado desde {offset})")
+                print(f"⚠️  Rango inesperado en la respuesta ({r.headers.get('Content-Range')!r}, esperado desde {offset}), se descarga desde el inicio")
+                return _stream_to_part(url, part_path, restarted=True)
+        if status == 200 and offset:
+            # El servidor ignora Range o el recurso ha cambiado (If-Range): empezar de cero
+            print('⚠️  El recurso ha cambiado o el servidor no admite reanudación (Range), se descarga desde el inicio')
+            offset = 0
+        elif offset:
+            print(f'↪️  Reanudando descarga desde {offset} bytes')
+        if not offset:
+            # Validador para reanudar esta descarga más adelante (los ETag débiles no valen para If-Range).
+            # Con codificación de transporte el .part tiene bytes decodificados: no se puede reanudar
+            etag = r.headers.get('ETag', '')
+            validator = etag if etag and not etag.startswith('W/') else r.headers.get('Last-Modified', '')
+            if validator and not encoded:
+                validator_path.write_text(validator, encoding='utf-8')
+            elif validator_path.exists():
+                validator_path.unlink()
+        expected = None if encoded else _expected_size(r, offset)
+
+        chunk_size = DOWNLOAD_CHUNK_MIN
         try:
-            with open(json_path, 'r', encoding='utf-8') as jf:
-                data = json.load(jf)
-
-            datos_url = data.get('datos')
-            if isinstance(datos_url, list):
-                datos_url = datos_url[0] if datos_url else None
-
-            if datos_url:
-                print(f"📥 Descargando paquete de alertas: {datos_url}")
-                ok = download_tar(datos_url, json_path.stem)
-                if not ok:
-                    print('❌ Falló la descarga/extracción del paquete de alertas')
-                    return 3
-            else:
-                print('⚠️  El campo "datos" no contiene URL válida')
-                return 4
-        except Exception as e:
-            print('❌ Error leyendo JSON local:', e)
-            return 5
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                while True:
+                    t0 = time.monotonic()
+                    chunk = r.raw.read(chunk_size, decode_content=encoded)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    # Tamaño de bloque adaptativo: crecer si el enlace va rápido, reducir si va lento
+                    elapsed = time.monotonic() - t0
+                    if elapsed < 0.25 and chunk_size < DOWNLOAD_CHUNK_MAX:
+                        chunk_size *= 2
+                    elif elapsed > 2.0 and chunk_size > DOWNLOAD_CHUNK_MIN:
+                        chunk_size //= 2
+        except Exception:
+            if encoded:
+                _discard_part(part_path)
+            raise
+        return expected
+
+
+def _verify_gzip(path: Path) -> bool:
+    """Descomprime `path` completo para validar CRC y longitud del gzip."""
+    try:
+        with gzip.open(path, 'rb') as g:
+            while g.read(1024 * 1024):
+                pass
+        return True
+    except (OSError, EOFError, zlib.error) as e:
+        print(f'❌ gzip inválido en {path.name}: {e}')
+        return False
 
-    finally:
-        release_lock()
-    return 0
 
+def download_file(url: str, prefix: str = 'aemet', out_dir: Path = None):
+    """Descarga un paquete desde la URL indicada y lo guarda en `out_dir` (por defecto DATA_DIR).
+    Devuelve la ruta final (renombrada según el formato detectado) o None si falla.
 
-def download_tar(url: str, prefix: str = 'aemet'):
-    """Descarga un tar.gz desde la URL indicada y guarda en DATA_DIR.
+    La descarga se escribe en `<nombre>.part` y se reanuda con HTTP Range tras
+    un corte (en esta ejecución o en la siguiente), con If-Range y el
+    ETag/Last-Modified guardado para no mezclar bytes de un recurso que ha
+    cambiado. Solo cuando el tamaño
+    coincide con Content-Length y el CRC del gzip es correcto se renombra
+    atómicamente al nombre final.
     Por defecto no guarda cabeceras de depuración en `data/alertas/debug`.
     Si se exporta `ALERTAS_DEBUG=1` se crearán esos ficheros.
     """
+    ts = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    # Determinar nombre de archivo
+    url_path = url.split('?')[0]
+    filename = url_path.split('/')[-1] or f'{prefix}-{ts}.tar.gz'
+    out_dir = out_dir or DATA_DIR
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_path = out_dir / filename
+    part_path = out_path.with_name(out_path.name + '.part')
+    clean_stale_parts(keep=part_path, out_dir=out_dir)
+
+    expected = None
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            expected = _stream_to_part(url, part_path)
+            break
+        except ValueError as e:
+            print(f'⚠️  No se pudo descargar el archivo ({e}).')
+            return None
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            print(f'❌ Error descargando tar.gz (intento {attempt}/{DOWNLOAD_RETRIES}):', e)
+        if attempt < DOWNLOAD_RETRIES:
+            time.sleep(min(2 ** attempt, 30))
+    else:
+        if part_path.exists():
+            print(f'❌ Descarga incompleta, se conserva {part_path.name} para reanudar')
+        else:
+            print('❌ Descarga incompleta, se reintentará desde el inicio')
+        return None
 
+    total = part_path.stat().st_size
+    if expected is not None and total != expected:
+        print(f'❌ Tamaño descargado ({total} bytes) distinto de Content-Length ({expected} bytes); se reanudará')
+        return None
+
+    # Detectar formato real leyendo cabecera
+    is_gzip = False
+    is_tar = False
     try:
-        with requests.get(url, stream=True, timeout=60, allow_redirects=True) as r:
-            status = r.status_code
-            ts = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-            headers_file = None
-            if WRITE_DEBUG:
-                debug_dir = DATA_DIR / 'debug'
-                debug_dir.mkdir(parents=True, exist_ok=True)
-                headers_file = debug_dir / f'headers-{ts}.txt'
-                with open(headers_file, 'w', encoding='utf-8') as hf:
-                    hf.write(f'STATUS: {status}\n')
-                    for k, v in r.headers.items():
-                        hf.write(f'{k}: {v}\n')
-
-            if status != 200:
-                if headers_file:
-                    print(f'⚠️  No se pudo descargar el archivo (HTTP {status}). Headers guardadas en: {headers_file}')
-                else:
-                    print(f'⚠️  No se pudo descargar el archivo (HTTP {status}).')
-                return False
-
-            # Determinar nombre de archivo
-            url_path = url.split('?')[0]
-            filename = url_path.split('/')[-1] or f'{prefix}-{ts}.tar.gz'
-            out_path = DATA_DIR / filename
-
-            # Guardar contenido en streaming
-            total = 0
-            with open(out_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        total += len(chunk)
-
-            # Detectar formato real leyendo cabecera
-            final_path = out_path
-            is_gzip = False
-            is_tar = False
-            try:
-                with open(final_path, 'rb') as fh:
-                    head = fh.read(4)
-                    # gzip magic 1f 8b
-                    if len(head) >= 2 and head[0] == 0x1f and head[1] == 0x8b:
-                        is_gzip = True
-                    # verificar magic 'ustar' en offset 257
-                    fh.seek(257)
-                    ustar = fh.read(5)
-                    if ustar == b'ustar':
-                        is_tar = True
-            except Exception:
-                pass
+        with open(part_path, 'rb') as fh:
+            head = fh.read(4)
+            # gzip magic 1f 8b
+            if len(head) >= 2 and head[0] == 0x1f and head[1] == 0x8b:
+                is_gzip = True
+            # verificar magic 'ustar' en offset 257
+            fh.seek(257)
+            ustar = fh.read(5)
+            if ustar == b'ustar':
+                is_tar = True
+    except Exception:
+        pass
 
-            # Renombrado informativo según formato detectado
-            try:
-                if is_gzip and not str(final_path).lower().endswith('.gz'):
-                    newp = final_path.with_name(final_path.name + '.gz')
-                    shutil.move(str(final_path), str(newp))
-                    final_path = newp
-                elif is_tar and not (str(final_path).lower().endswith('.tar') or str(final_path).lower().endswith('.tar.gz')):
-                    newp = final_path.with_name(final_path.name + '.tar')
-                    shutil.move(str(final_path), str(newp))
-                    final_path = newp
-            except Exception:
-                pass
+    if is_gzip and not _verify_gzip(part_path):
+        # Contenido corrupto: no se puede reanudar, descartar
+        _discard_part(part_path)
+        return None
 
-            print(f"✅ Archivo guardado en: {final_path} ({total} bytes) -- gzip={is_gzip} tar={is_tar}")
+    # Nombre final según formato detectado
+    final_path = out_path
+    if is_gzip and not str(final_path).lower().endswith('.gz'):
+        final_path = final_path.with_name(final_path.name + '.gz')
+    elif is_tar and not (str(final_path).lower().endswith('.tar') or str(final_path).lower().endswith('.tar.gz')):
+        final_path = final_path.with_name(final_path.name + '.tar')
+    # Renombrado atómico: el fichero final solo aparece completo y verificado
+    os.replace(part_path, final_path)
+    _discard_part(part_path)
 
-            # Extraer en DATA_DIR/tmp (limpiando previamente)
-            tmp_dir = DATA_DIR / 'tmp'
-            try:
-                if tmp_dir.exists():
-                    shutil.rmtree(tmp_dir)
-                tmp_dir.mkdir(parents=True, exist_ok=True)
-                print(f"📦 Extrayendo {final_path.name} a {tmp_dir} (modo automático)")
-                with tarfile.open(final_path, 'r:*') as tarf:
-                    tarf.extractall(path=tmp_dir)
-                print(f"✅ Extracción completada en: {tmp_dir}")
-            except tarfile.ReadError:
-                print(f"⚠️  Archivo {final_path} no es un tar válido o está corrupto (ReadError)")
-            except Exception as e:
-                print(f"❌ Error extrayendo archivo: {e}")
-
-            # Después de extraer, parsear XML/CAP y generar CSV único (no verdes)
-            try:
-                parse_tmp_and_write_raw_csv(tmp_dir)
-            except Exception as e:
-                print('❌ Error parsing XML/CAP:', e)
+    print(f"✅ Archivo guardado en: {final_path} ({total} bytes) -- gzip={is_gzip} tar={is_tar}")
+    return final_path
 
-            return True
-    except requests.RequestException as e:
-        print('❌ Error descargando tar.gz:', e)
-        return False
+
+def extract_tar(archive: Path, dest_dir: Path) -> bool:
+    """Extrae `archive` en `dest_dir` (limpiándolo previamente). Devuelve True si se extrajo."""
+    try:
+        if dest_dir.exists():
+            shutil.rmtree(dest_dir)
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        print(f"📦 Extrayendo {archive.name} a {dest_dir} (modo automático)")
+        with tarfile.open(archive, 'r:*') as tarf:
+            tarf.extractall(path=dest_dir)
+        print(f"✅ Extracción completada en: {dest_dir}")
+        return True
+    except tarfile.ReadError:
+        print(f"⚠️  Archivo {archive} no es un tar válido o está corrupto (ReadError)")
+    except Exception as e:
+        print(f"❌ Error extrayendo archivo: {e}")
+    return False
 
 
 def normalize_text(s: str) -> str:
@@ -315,13 +476,13 @@ PROVINCIAS_NORM = {normalize_text(v): k for k, v in PROVINCIAS.items()}
 PROV_NAMES = list(PROVINCIAS_NORM.keys())
 
 
-def extract_entries_from_xml(xml_content: str):
+def entry_nodes_from_xml(xml_content: str):
+    """Nodos XML de los avisos del documento (entry, alert, item, info, o la raíz si no hay)."""
     import xml.etree.ElementTree as ET
-    entries = []
     try:
         root = ET.fromstring(xml_content)
     except ET.ParseError:
-        return entries
+        return []
 
     # Buscar nodos relevantes: entry, alert, item, info
     candidates = []
@@ -329,20 +490,22 @@ def extract_entries_from_xml(xml_content: str):
         candidates.extend(root.findall('.//{}'.format(tag)))
 
     # Si no hay nodos, tratar todo el documento como una entrada
-    if not candidates:
-        candidates = [root]
+    return candidates or [root]
+
 
-    for node in candidates:
-        texts = []
-        for elem in node.iter():
-            if elem.text:
-                texts.append(elem.text)
-            if elem.tail:
-                texts.append(elem.tail)
-        full = ' '.join(t.strip() for t in texts if t and t.strip())
-        entries.append(full)
+def node_text(node) -> str:
+    """Texto de un nodo y sus descendientes en una sola línea."""
+    texts = []
+    for elem in node.iter():
+        if elem.text:
+            texts.append(elem.text)
+        if elem.tail:
+            texts.append(elem.tail)
+    return ' '.join(t.strip() for t in texts if t and t.strip())
 
-    return entries
+
+def extract_entries_from_xml(xml_content: str):
+    return [node_text(node) for node in entry_nodes_from_xml(xml_content)]
 
 
 def detect_level(text: str) -> str:
@@ -406,275 +569,128 @@ def extract_start_date(text: str):
     return None
 
 
-def _parse_iso_or_min(s: str):
-    from datetime import datetime
-    if not s:
-        return datetime.min
-    try:
-        # replace Z with +00:00 for fromisoformat
-        s2 = s.replace('Z', '+00:00')
-        return datetime.fromisoformat(s2)
-    except Exception:
-        try:
-            return datetime.fromisoformat(s)
-        except Exception:
-            return datetime.min
-
-
-def parse_tmp_and_write_csv(tmp_dir: Path):
-    # Localizar todos los archivos XML/CAP dentro de tmp_dir
+def find_cap_files(tmp_dir: Path):
+    """Devuelve las rutas de los ficheros XML/CAP bajo `tmp_dir`."""
     files = []
     for root, _, filenames in os.walk(tmp_dir):
         for fn in filenames:
             if fn.lower().endswith(('.xml', '.cap')) or fn.lower().endswith('.xml.gz'):
                 files.append(os.path.join(root, fn))
+    return files
 
-    if not files:
-        print('⚠️  No se encontraron archivos XML/CAP en tmp para procesar')
-        return
-
-    alertas_por_subprov = {}
-    priority = {'verde': 1, 'amarillo': 2, 'naranja': 3, 'rojo': 4}
-
-    # regex para intentar extraer subprovincia/zona/area de texto
-    subprov_regex = re.compile(r"\b(?:zona|área|area|sector|zona de|área de|sector de)\s*(?:de\s*)?([A-Za-zÁÉÍÓÚáéíóúñÑ0-9 \-\/]+?)(?:[\.,;\n]|$)", re.IGNORECASE)
 
-    for fpath in files:
+def decode_bytes(raw: bytes) -> str:
+    try:
+        return raw.decode('utf-8')
+    except Exception:
         try:
-            with open(fpath, 'rb') as fh:
-                raw = fh.read()
-            try:
-                text = raw.decode('utf-8')
-            except Exception:
-                try:
-                    text = raw.decode('latin1')
-                except Exception:
-                    text = ''
-
-            entries = extract_entries_from_xml(text)
-
-            for entry in entries:
-                nivel = detect_level(entry)
-                if nivel == 'verde':
-                    continue  # filtrar verdes
-
-                # excluir avisos costeros
-                fenomeno_check = detect_phenomenon(entry) or ''
-                if is_coastal(fenomeno_check) or is_coastal(entry):
-                    continue
-
-                prov = detect_province(entry)
-                # intentar extraer subprovincia (zona/área)
-                subprov = None
-                m = subprov_regex.search(entry)
-                if m:
-                    subprov = m.group(1).strip()
-
-                if not subprov:
-                    # si no hay subprov detectada, intentar extraer frase después de 'en' como fallback
-                    m2 = re.search(r'en\s+([A-Za-zÁÉÍÓÚáéíóúñÑ0-9 \,\-]+?)(?:[\.,;\n]|$)', entry, re.IGNORECASE)
-                    if m2:
-                        subprov = m2.group(1).strip()
-
-                # Detección específica de 'meseta' (meseta de soria / meseta de segovia)
-                if not subprov:
-                    mm = re.search(r'meseta\s+de\s*(soria|segovia)', entry, re.IGNORECASE)
-                    if mm:
-                        subprov = f"Meseta de {mm.group(1).capitalize()}"
-
-                # Si sigue sin subprov y la provincia es Ávila (05), intentar mapear por menciones
-                if not subprov and prov == '05':
-                    if re.search(r'\bsoria\b', entry, re.IGNORECASE):
-                        subprov = 'Meseta de Soria'
-                    elif re.search(r'\bsegovia\b', entry, re.IGNORECASE):
-                        subprov = 'Meseta de Segovia'
-
-                if not prov and not subprov:
-                    continue
-
-                fenomeno = detect_phenomenon(entry) or 'null'
-                ts = datetime.utcnow().isoformat()
-
-                key = f"{prov or '00'}::{subprov or 'general'}"
-                current = alertas_por_subprov.get(key)
-                if not current or priority[nivel] > priority[current['nivel']]:
-                    alertas_por_subprov[key] = {
-                        'prov': prov,
-                        'subprov': subprov,
-                        'nivel': nivel,
-                        'fenomeno': fenomeno,
-                        'timestamp': ts
-                    }
-        except Exception as e:
-            print('⚠️  Error procesando', fpath, e)
+            return raw.decode('latin1')
+        except Exception:
+            return ''
 
-    if not alertas_por_subprov:
-        print('⚠️  No se detectaron alertas (no verdes) tras procesar XMLs')
-        return
 
-    # Escribir CSV en data/alertas/alertas-YYYYMMDD-HHMM.csv
-    now = datetime.utcnow().strftime('%Y%m%d-%H%M')
-    out_dir = Path(__file__).resolve().parents[2] / 'data'
-    out_dir.mkdir(parents=True, exist_ok=True)
-    out_file = out_dir / f'alertas-{now}.csv'
-    with open(out_file, 'w', encoding='utf-8', newline='') as csvf:
-        writer = csv.writer(csvf)
-        writer.writerow(['codigo_provincia', 'nombre_provincia', 'subprovincia', 'nivel', 'fenomeno', 'timestamp'])
-        for key in sorted(alertas_por_subprov.keys()):
-            datos = alertas_por_subprov[key]
-            codigo = datos['prov'] or ''
-            nombre = PROVINCIAS.get(codigo, '')
-            writer.writerow([codigo, nombre, datos['subprov'], datos['nivel'], datos['fenomeno'], datos['timestamp']])
-
-    # eliminar otros alertas-*.csv en la carpeta `data/`, dejando solo el último
-    try:
-        for f in out_dir.glob('alertas-*.csv'):
-            if f.resolve() != out_file.resolve():
-                try:
-                    f.unlink()
-                except Exception:
-                    pass
-    except Exception:
-        pass
+def province_region(text: str):
+    """Mapea un texto de aviso a `(codigo_provincia, nombre_provincia)`."""
+    prov = detect_province(text) or ''
+    return prov, PROVINCIAS.get(prov, '')
 
-    print(f"✅ CSV de alertas (no verdes) guardado en: {out_file}")
 
+def node_province_region(node):
+    """Mapea el nodo XML de un aviso a `(codigo_provincia, nombre_provincia)` a partir de su texto."""
+    return province_region(node_text(node))
 
-def parse_tmp_and_write_raw_csv(tmp_dir: Path):
-    """Genera un CSV con todas las alertas (amarillo/naranja/rojo) sin agrupar.
-    Columnas: codigo_provincia, nombre_provincia, subprovincia, nivel, fenomeno, timestamp, source_file, excerpt
-    También genera alertas-latest.csv con formato simplificado para la API Node.js
-    """
-    files = []
-    for root, _, filenames in os.walk(tmp_dir):
-        for fn in filenames:
-            if fn.lower().endswith(('.xml', '.cap')) or fn.lower().endswith('.xml.gz'):
-                files.append(os.path.join(root, fn))
 
-    if not files:
-        print('⚠️  No se encontraron archivos XML/CAP en tmp para procesar (raw)')
-        return
+def alert_records_from_text(text: str, map_area=node_province_region):
+    """Extrae los avisos (amarillo/naranja/rojo) de un documento CAP de AEMET.
 
+    Genera dicts con claves: prov, nombre, subprov, nivel, fenomeno, start, excerpt.
+    `map_area` convierte el nodo XML del aviso en `(codigo, nombre)` de la región.
+    """
+    for node in entry_nodes_from_xml(text):
+        entry = node_text(node)
+        nivel = detect_level(entry)
+        if nivel == 'verde':
+            continue
+        # excluir avisos costeros
+        fenomeno_check = detect_phenomenon(entry) or ''
+        if is_coastal(fenomeno_check) or is_coastal(entry):
+            continue
+        prov, nombre = map_area(node)
+        # intentar extraer subprovincia
+        subprov = None
+        m = re.search(r"\b(?:zona|área|area|sector|meseta)\s*(?:de\s*)?([A-Za-zÁÉÍÓÚáéíóúñÑ0-9 \-\/]+?)(?:[\.,;\n]|$)", entry, re.IGNORECASE)
+        if m:
+            subprov = m.group(1).strip()
+        if not subprov:
+            m2 = re.search(r'en\s+([A-Za-zÁÉÍÓÚáéíóúñÑ0-9 \,\-]+?)(?:[\.,;\n]|$)', entry, re.IGNORECASE)
+            if m2:
+                subprov = m2.group(1).strip()
+
+        yield {
+            'prov': prov,
+            'nombre': nombre,
+            'subprov': subprov,
+            'nivel': nivel,
+            'fenomeno': detect_phenomenon(entry) or '',
+            # intentar extraer fecha de inicio del evento desde el contenido
+            'start': extract_start_date(entry),
+            'excerpt': ' '.join(entry.split())[:300],
+        }
+
+
+def alert_records_from_file(fpath, parse=alert_records_from_text):
+    """Lee `fpath` y genera sus avisos con `parse` (la lectura ocurre al iterar)."""
+    with open(fpath, 'rb') as fh:
+        raw = fh.read()
+    yield from parse(decode_bytes(raw))
+
+
+def collect_raw_rows(documents):
+    """Recorre `documents` (iterable de `(fuente, fpath, registros)`) y construye las filas del CSV raw.
+
+    Devuelve `(rows, alertas_por_provincia)`, donde el segundo agrupa el nivel
+    más alto por código de región para el CSV simplificado. El `timestamp` (y
+    el `start` que falte) quedan a None: los pone `write_raw_csv` al escribir,
+    así el resultado solo depende de los documentos y su digest es estable.
+    """
     rows = []
     # Agrupar alertas por provincia para el CSV simplificado
     alertas_por_provincia = {}
-    
-    for fpath in files:
+    niveles_orden = {'amarillo': 1, 'naranja': 2, 'rojo': 3}
+
+    for fuente, fpath, registros in documents:
         try:
-            with open(fpath, 'rb') as fh:
-                raw = fh.read()
-            try:
-                text = raw.decode('utf-8')
-            except Exception:
-                try:
-                    text = raw.decode('latin1')
-                except Exception:
-                    text = ''
-
-            entries = extract_entries_from_xml(text)
-            for entry in entries:
-                nivel = detect_level(entry)
-                if nivel == 'verde':
-                    continue
-                # excluir avisos costeros
-                fenomeno_check = detect_phenomenon(entry) or ''
-                if is_coastal(fenomeno_check) or is_coastal(entry):
-                    continue
-                prov = detect_province(entry) or ''
-                # intentar extraer subprovincia
-                subprov = None
-                m = re.search(r"\b(?:zona|área|area|sector|meseta)\s*(?:de\s*)?([A-Za-zÁÉÍÓÚáéíóúñÑ0-9 \-\/]+?)(?:[\.,;\n]|$)", entry, re.IGNORECASE)
-                if m:
-                    subprov = m.group(1).strip()
-                if not subprov:
-                    m2 = re.search(r'en\s+([A-Za-zÁÉÍÓÚáéíóúñÑ0-9 \,\-]+?)(?:[\.,;\n]|$)', entry, re.IGNORECASE)
-                    if m2:
-                        subprov = m2.group(1).strip()
-
-                fenomeno = detect_phenomenon(entry) or ''
-                ts = datetime.utcnow().isoformat()
-                # intentar extraer fecha de inicio del evento desde el contenido
-                start = extract_start_date(entry) or ts
-                excerpt = ' '.join(entry.split())[:300]
-                rows.append([prov, PROVINCIAS.get(prov, ''), subprov, nivel, fenomeno, start, ts, os.path.basename(fpath), excerpt])
-                
+            for reg in registros:
+                prov = reg['prov']
+                nivel = reg['nivel']
+                fenomeno = reg['fenomeno']
+                start = reg.get('start')
+                rows.append([prov, reg['nombre'], reg['subprov'], nivel, fenomeno, start, None, os.path.basename(fpath), reg['excerpt'], fuente])
+
                 # Guardar el nivel más alto por provincia
                 if prov and prov not in alertas_por_provincia:
                     alertas_por_provincia[prov] = {
-                        'nombre': PROVINCIAS.get(prov, ''),
+                        'nombre': reg['nombre'],
                         'nivel': nivel,
                         'fenomeno': fenomeno,
-                        'timestamp': ts
+                        'timestamp': None
                     }
                 elif prov:
                     # Actualizar si el nuevo nivel es más alto
-                    niveles_orden = {'amarillo': 1, 'naranja': 2, 'rojo': 3}
                     if niveles_orden.get(nivel, 0) > niveles_orden.get(alertas_por_provincia[prov]['nivel'], 0):
                         alertas_por_provincia[prov]['nivel'] = nivel
                         alertas_por_provincia[prov]['fenomeno'] = fenomeno
-                        alertas_por_provincia[prov]['timestamp'] = ts
         except Exception as e:
             print('⚠️  Error procesando (raw)', fpath, e)
 
-    if not rows:
-        print('⚠️  No se encontraron alertas (raw) tras procesar XMLs')
-        return
-
-    now = datetime.utcnow().strftime('%Y%m%d-%H%M')
-    out_dir = Path(__file__).resolve().parents[2] / 'data'
-    out_dir.mkdir(parents=True, exist_ok=True)
-    out_file = out_dir / f'alertas-{now}.csv'
-    # ordenar por codigo provincia, luego por fecha de inicio (start)
-    try:
-        rows.sort(key=lambda r: (r[0] or '', _parse_iso_or_min(r[5])))
-    except Exception:
-        pass
-
-    with open(out_file, 'w', encoding='utf-8', newline='') as csvf:
-        writer = csv.writer(csvf)
-        writer.writerow(['codigo_provincia', 'nombre_provincia', 'subprovincia', 'nivel', 'fenomeno', 'start', 'timestamp', 'source_file', 'excerpt'])
-        for r in rows:
-            writer.writerow(r)
-
-    # Escribir CSV simplificado para la API Node.js
-    latest_file = out_dir / 'alertas-latest.csv'
-    with open(latest_file, 'w', encoding='utf-8', newline='') as csvf:
-        writer = csv.writer(csvf)
-        writer.writerow(['codigo_provincia', 'nombre_provincia', 'nivel', 'fenomeno', 'timestamp'])
-        for codigo, datos in alertas_por_provincia.items():
-            writer.writerow([
-                codigo,
-                datos['nombre'],
-                datos['nivel'],
-                datos.get('fenomeno') or 'null',
-                datos['timestamp']
-            ])
-
-    # eliminar otros alertas-*.csv en la carpeta `data/`, dejando solo el último
-    try:
-        for f in out_dir.glob('alertas-*.csv'):
-            if f.resolve() != out_file.resolve():
-                try:
-                    f.unlink()
-                except Exception:
-                    pass
-    except Exception:
-        pass
-
-    print(f"✅ CSV de alertas (no verdes) guardado en: {out_file}")
-    print(f"✅ CSV simplificado generado en: {latest_file}")
+    return rows, alertas_por_provincia
 
 
-def clean_debug_and_tmp():
+def clean_debug():
     try:
         d = DATA_DIR / 'debug'
-        t = DATA_DIR / 'tmp'
         if d.exists() and d.is_dir():
             shutil.rmtree(d)
-        if t.exists() and t.is_dir():
-            shutil.rmtree(t)
-        # recrear tmp vacía
-        (DATA_DIR / 'tmp').mkdir(parents=True, exist_ok=True)
     except Exception:
         pass
 
@@ -702,4 +718,6 @@ def main():
 
 
 if __name__ == '__main__':
+    # Registrar este módulo con su nombre para que `sources` reutilice la misma instancia
+    sys.modules.setdefault('alert_downloader', sys.modules[__name__])
     sys.exit(main())
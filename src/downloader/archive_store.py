@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""Almacén de paquetes raw direccionado por contenido.
+
+Cada miembro (documento CAP) de un paquete descargado se guarda una sola vez,
+comprimido con gzip y nombrado por el SHA-256 de su contenido:
+
+  <ARCHIVE_DIR>/objects/ab/abcdef....gz
+  <ARCHIVE_DIR>/manifests/<run_id>.json   -> lista de miembros (nombre, hash, tamaño...)
+
+Como la mayoría de miembros no cambian de una hora a otra, cada ejecución
+solo añade los documentos nuevos más un manifiesto pequeño. Con el
+manifiesto se puede reconstruir cualquier paquete pasado.
+
+Usage:
+  python3 src/downloader/archive_store.py list [--source NAME]
+  python3 src/downloader/archive_store.py rebuild RUN_ID OUT.tar.gz
+  python3 src/downloader/archive_store.py extract RUN_ID DIR
+  python3 src/downloader/archive_store.py gc [--keep-last N] [--max-age-days D]
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[0]))
+from alert_downloader import DATA_DIR
+
+ARCHIVE_ENABLED = os.getenv('ALERTAS_ARCHIVE', '1') in ('1', 'true', 'True')
+ARCHIVE_DIR = Path(os.getenv('ALERTAS_ARCHIVE_DIR') or str(DATA_DIR / 'archive'))
+# Retención: se conservan siempre las N ejecuciones más recientes y, además,
+# todas las de menos de D días. Los objetos sin manifiesto que los use se borran.
+ARCHIVE_KEEP_RUNS = int(os.getenv('ALERTAS_ARCHIVE_KEEP_RUNS', '48'))
+ARCHIVE_MAX_AGE_DAYS = int(os.getenv('ALERTAS_ARCHIVE_MAX_AGE_DAYS', '90'))
+
+
+def _objects_dir() -> Path:
+    return ARCHIVE_DIR / 'objects'
+
+
+def _manifests_dir() -> Path:
+    return ARCHIVE_DIR / 'manifests'
+
+
+def object_path(digest: str) -> Path:
+    return _objects_dir() / digest[:2] / f'{digest}.gz'
+
+
+def _atomic_write(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _write_new(path: Path, data: bytes):
+    """Como `_atomic_write`, pero falla con FileExistsError si `path` ya existe (nunca sobrescribe)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    try:
+        os.link(tmp, path)
+    finally:
+        os.unlink(tmp)
+
+
+def put_object(data: bytes) -> str:
+    """Guarda `data` si no existe ya y devuelve su SHA-256."""
+    digest = hashlib.sha256(data).hexdigest()
+    path = object_path(digest)
+    try:
+        # Al reutilizar un objeto se renueva su mtime: así el margen de 1h de `gc()`
+        # lo protege hasta que se escriba el manifiesto que lo referencia
+        os.utime(path)
+    except FileNotFoundError:
+        # mtime=0 para que el mismo contenido produzca siempre los mismos bytes
+        _atomic_write(path, gzip.compress(data, compresslevel=6, mtime=0))
+    return digest
+
+
+def get_object(digest: str) -> bytes:
+    """Lee un objeto y verifica que su contenido corresponde al hash."""
+    data = gzip.decompress(object_path(digest).read_bytes())
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f'objeto corrupto en el archivo: {digest}')
+    return data
+
+
+def _store_members(members, source: str, package: str, run_id: str = None) -> str:
+    """Guarda los miembros `(nombre, bytes, mode, mtime)` y escribe el manifiesto. Devuelve el run_id."""
+    created = datetime.utcnow()
+    # Sufijo aleatorio: dos paquetes archivados en el mismo segundo no comparten manifiesto
+    run_id = run_id or f"{created.strftime('%Y%m%dT%H%M%SZ')}-{source}-{uuid.uuid4().hex[:6]}"
+    entries = []
+    nuevos = 0
+    for name, data, mode, mtime in members:
+        existed = object_path(hashlib.sha256(data).hexdigest()).exists()
+        digest = put_object(data)
+        nuevos += 0 if existed else 1
+        entries.append({'name': name, 'sha256': digest, 'size': len(data), 'mode': mode, 'mtime': mtime})
+
+    manifest = {
+        'run_id': run_id,
+        'source': source,
+        'package': package,
+        'created': created.isoformat(),
+        'members': entries,
+    }
+    _write_new(_manifests_dir() / f'{run_id}.json',
+               json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'))
+    print(f"🗄️  Paquete archivado como {run_id}: {len(entries)} miembros, {nuevos} nuevos")
+    return run_id
+
+
+def store_package(archive: Path, source: str = 'aemet', run_id: str = None) -> str:
+    """Archiva los ficheros regulares de un tar (gz o no)."""
+    def members():
+        with tarfile.open(archive, 'r:*') as tarf:
+            for info in tarf:
+                if not info.isfile():
+                    continue
+                yield info.name, tarf.extractfile(info).read(), info.mode, int(info.mtime)
+
+    return _store_members(members(), source, archive.name, run_id)
+
+
+def store_directory(directory: Path, source: str, run_id: str = None) -> str:
+    """Archiva los ficheros de una carpeta (fuentes que no descargan un tar, p.ej. MeteoAlarm)."""
+    def members():
+        for path in sorted(p for p in directory.rglob('*') if p.is_file()):
+            st = path.stat()
+            yield path.relative_to(directory).as_posix(), path.read_bytes(), st.st_mode & 0o777, int(st.st_mtime)
+
+    return _store_members(members(), source, directory.name, run_id)
+
+
+def load_manifest(run_id: str) -> dict:
+    with open(_manifests_dir() / f'{run_id}.json', 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def list_runs(source: str = None):
+    """Manifiestos archivados, del más antiguo al más reciente."""
+    runs = []
+    if not _manifests_dir().exists():
+        return runs
+    for path in _manifests_dir().glob('*.json'):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except Exception:
+            continue
+        if source and manifest.get('source') != source:
+            continue
+        runs.append(manifest)
+    runs.sort(key=lambda m: m.get('created', ''))
+    return runs
+
+
+def latest_run(source: str = None):
+    runs = list_runs(source)
+    return runs[-1]['run_id'] if runs else None
+
+
+def rebuild_package(run_id: str, out_path: Path) -> Path:
+    """Reconstruye el tar.gz de una ejecución a partir de su manifiesto."""
+    manifest = load_manifest(run_id)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with tarfile.open(out_path, 'w:gz') as tarf:
+        for m in manifest['members']:
+            data = get_object(m['sha256'])
+            info = tarfile.TarInfo(m['name'])
+            info.size = len(data)
+            info.mode = m.get('mode', 0o644)
+            info.mtime = m.get('mtime', 0)
+            tarf.addfile(info, io.BytesIO(data))
+    return out_path
+
+
+def extract_run(run_id: str, dest_dir: Path) -> Path:
+    """Escribe los miembros de una ejecución en `dest_dir` (como si se hubiera extraído el tar)."""
+    manifest = load_manifest(run_id)
+    root = dest_dir.resolve()
+    for m in manifest['members']:
+        target = (dest_dir / m['name']).resolve()
+        if root not in target.parents:
+            raise ValueError(f"ruta de miembro no válida: {m['name']}")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(get_object(m['sha256']))
+    return dest_dir
+
+
+def gc(keep_last: int = None, max_age_days: int = None):
+    """Aplica la retención de manifiestos y borra los objetos que ya no referencia ninguno.
+
+    Devuelve `(manifiestos_borrados, objetos_borrados)`.
+    """
+    keep_last = ARCHIVE_KEEP_RUNS if keep_last is None else keep_last
+    max_age_days = ARCHIVE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    limit = (datetime.utcnow() - timedelta(days=max_age_days)).isoformat()
+
+    runs = list_runs()
+    keep = {m['run_id'] for m in runs[-keep_last:]} if keep_last > 0 else set()
+    removed_runs = 0
+    for manifest in runs:
+        if manifest['run_id'] in keep or manifest.get('created', '') >= limit:
+            continue
+        try:
+            (_manifests_dir() / f"{manifest['run_id']}.json").unlink()
+            removed_runs += 1
+        except Exception:
+            pass
+
+    referenced = set()
+    for manifest in list_runs():
+        referenced.update(m['sha256'] for m in manifest['members'])
+
+    removed_objects = 0
+    now = time.time()
+    if _objects_dir().exists():
+        for path in _objects_dir().glob('*/*.gz'):
+            if path.name[:-3] in referenced:
+                continue
+            # no tocar objetos recién escritos por una ejecución que aún no ha guardado su manifiesto
+            try:
+                if now - path.stat().st_mtime < 3600:
+                    continue
+                path.unlink()
+                removed_objects += 1
+            except Exception:
+                pass
+
+    if removed_runs or removed_objects:
+        print(f"🧹 Archivo: {removed_runs} manifiestos y {removed_objects} objetos eliminados")
+    return removed_runs, removed_objects
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archivo raw de paquetes de avisos')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p_list = sub.add_parser('list', help='List archived runs')
+    p_list.add_argument('--source', help='Only runs from this source')
+    p_rebuild = sub.add_parser('rebuild', help='Rebuild the tar.gz of a run')
+    p_rebuild.add_argument('run_id')
+    p_rebuild.add_argument('out')
+    p_extract = sub.add_parser('extract', help='Extract the members of a run into a directory')
+    p_extract.add_argument('run_id')
+    p_extract.add_argument('dest')
+    p_gc = sub.add_parser('gc', help='Apply retention and remove unreferenced objects')
+    p_gc.add_argument('--keep-last', type=int, default=None)
+    p_gc.add_argument('--max-age-days', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.cmd == 'list':
+        for m in list_runs(args.source):
+            size = sum(e['size'] for e in m['members'])
+            print(f"{m['run_id']}\t{m['source']}\t{len(m['members'])} miembros\t{size} bytes")
+    elif args.cmd == 'rebuild':
+        print('Rebuilt:', rebuild_package(args.run_id, Path(args.out)))
+    elif args.cmd == 'extract':
+        print('Extracted:', extract_run(args.run_id, Path(args.dest)))
+    elif args.cmd == 'gc':
+        gc(args.keep_last, args.max_age_days)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
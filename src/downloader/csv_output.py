@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Escritura de los CSV de alertas que lee la API Node.js.
+
+Está separado del parseo para que la etapa publish del pipeline dependa solo
+de este módulo: un cambio de formato de los CSV repite la publicación sin
+volver a parsear (ver `pipeline.py`).
+"""
+import csv
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+
+def _parse_iso_or_min(s: str):
+    if not s:
+        return datetime.min
+    try:
+        # replace Z with +00:00 for fromisoformat
+        s2 = s.replace('Z', '+00:00')
+        return datetime.fromisoformat(s2)
+    except Exception:
+        try:
+            return datetime.fromisoformat(s)
+        except Exception:
+            return datetime.min
+
+
+def _write_csv_atomic(path: Path, header, rows):
+    """Escribe el CSV en un temporal y lo renombra: los lectores ven el fichero anterior o el nuevo, nunca uno a medias."""
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    with open(tmp, 'w', encoding='utf-8', newline='') as csvf:
+        writer = csv.writer(csvf)
+        writer.writerow(header)
+        for r in rows:
+            writer.writerow(r)
+    os.replace(tmp, path)
+
+
+LEGACY_DIR = Path(__file__).resolve().parents[2] / 'data'
+
+
+def _clean_old_csv(d: Path, keep):
+    """Elimina otros alertas-*.csv en la carpeta, dejando solo los indicados."""
+    keep = {k.resolve() for k in keep}
+    try:
+        for f in d.glob('alertas-*.csv'):
+            if f.resolve() not in keep:
+                try:
+                    f.unlink()
+                except Exception:
+                    pass
+    except Exception:
+        pass
+
+
+def write_raw_csv(rows, alertas_por_provincia, out_dir: Path = None):
+    """Escribe el CSV raw con marca de tiempo y `alertas-latest.csv` en `out_dir`.
+    Por defecto en `data/`; el pipeline escribe en su generación (ver generations.py)
+    y copia a `data/` con `mirror_to_legacy` solo tras publicarla.
+    """
+    d = out_dir if out_dir is not None else LEGACY_DIR
+    d.mkdir(parents=True, exist_ok=True)
+    created = datetime.utcnow()
+    now = created.strftime('%Y%m%d-%H%M')
+    # `collect_raw_rows` deja sin hora las filas: se marcan con la de escritura
+    ts = created.isoformat()
+    rows = [list(r[:5]) + [r[5] or ts, r[6] or ts] + list(r[7:]) for r in rows]
+    # ordenar por codigo provincia, luego por fecha de inicio (start)
+    try:
+        rows.sort(key=lambda r: (r[0] or '', _parse_iso_or_min(r[5])))
+    except Exception:
+        pass
+
+    out_file = d / f'alertas-{now}.csv'
+    _write_csv_atomic(out_file, ['codigo_provincia', 'nombre_provincia', 'subprovincia', 'nivel', 'fenomeno', 'start', 'timestamp', 'source_file', 'excerpt', 'fuente'], rows)
+
+    # Escribir CSV simplificado para la API Node.js
+    latest_file = d / 'alertas-latest.csv'
+    latest_rows = [
+        [codigo, datos['nombre'], datos['nivel'], datos.get('fenomeno') or 'null', datos.get('timestamp') or ts]
+        for codigo, datos in alertas_por_provincia.items()
+    ]
+    _write_csv_atomic(latest_file, ['codigo_provincia', 'nombre_provincia', 'nivel', 'fenomeno', 'timestamp'], latest_rows)
+
+    _clean_old_csv(d, (out_file, latest_file))
+    print(f"✅ CSV de alertas (no verdes) guardado en: {out_file}")
+    print(f"✅ CSV simplificado generado en: {latest_file}")
+
+
+def mirror_to_legacy(gen: Path, legacy_dir: Path = None):
+    """Copia los CSV de una generación publicada a `data/` (respaldo de la API Node).
+
+    Llamar con `generations.publish_lock()` tomado y `gen` = generación actual,
+    para que la copia nunca retroceda a datos de una generación anterior.
+    """
+    d = legacy_dir or LEGACY_DIR
+    files = sorted(gen.glob('alertas-*.csv'))
+    if not files:
+        return
+    d.mkdir(parents=True, exist_ok=True)
+    for f in files:
+        tmp = d / f'.{f.name}.{os.getpid()}.tmp'
+        shutil.copyfile(f, tmp)
+        os.replace(tmp, d / f.name)
+    _clean_old_csv(d, [d / f.name for f in files])
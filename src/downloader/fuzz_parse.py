@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""Fuzzing diferencial de las funciones de parseo de avisos.
+
+Compara la implementación actual (`alert_downloader`) con una ruta candidata
+(p.ej. una versión optimizada) sobre entradas CAP/XML generadas y mutadas:
+acentos y formas descompuestas, mezcla de codificaciones, XML malformado,
+documentos enormes, offsets horarios raros... Cada divergencia se reduce a
+un reproductor mínimo, y ambas versiones se cronometran sobre las mismas
+entradas.
+
+Usage:
+  python3 src/downloader/fuzz_parse.py --candidate MODULE_OR_FILE [--iterations N] [--seed S]
+                                       [--corpus DIR] [--out DIR] [--max-report N]
+
+La candidata es un módulo (o fichero .py) que define alguna de las funciones
+comparadas con la misma firma; solo se comparan las que defina. Sin
+--candidate se compara la implementación consigo misma (útil para medir
+tiempos y comprobar el propio harness). Devuelve 1 si hay divergencias.
+"""
+import argparse
+import importlib
+import importlib.util
+import json
+import random
+import sys
+import time
+import unicodedata
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[0]))
+import alert_downloader
+from alert_downloader import PROVINCIAS, decode_bytes
+
+FUNCTIONS = (
+    'extract_entries_from_xml',
+    'detect_level',
+    'detect_province',
+    'detect_phenomenon',
+    'is_coastal',
+    'extract_start_date',
+)
+# Funciones que reciben un documento XML completo; el resto reciben el texto de una entrada
+DOCUMENT_FUNCTIONS = ('extract_entries_from_xml',)
+
+CAP_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<alert xmlns="urn:oasis:names:tc:emergency:cap:1.2">
+<identifier>2.49.0.0.724.0.ES.{ident}</identifier>
+<sender>http://www.aemet.es</sender>
+<sent>{sent}</sent>
+<status>Actual</status><msgType>Alert</msgType><scope>Public</scope>
+{infos}
+</alert>'''
+
+INFO_TEMPLATE = '''<info>
+<language>es-ES</language>
+<category>Met</category>
+<event>Aviso de {fenomeno} de nivel {nivel}</event>
+<severity>{severity}</severity>
+<onset>{onset}</onset>
+<headline>Aviso {nivel}. {fenomeno} en {zona}</headline>
+<description>{descripcion}</description>
+<parameter><valueName>AEMET-Meteoalerta nivel</valueName><value>{nivel}</value></parameter>
+<area><areaDesc>{zona}</areaDesc><geocode><valueName>AEMET-Meteoalerta zona</valueName><value>{codigo}</value></geocode></area>
+</info>'''
+
+NIVELES = ['verde', 'amarillo', 'naranja', 'rojo', 'Rojo', 'NARANJA', 'extremo', 'importante', 'riesgo', 'nivel 2', 'nivel  3', 'nivel4']
+FENOMENOS = ['viento', 'lluvias', 'nevadas', 'tormentas', 'temperaturas máximas', 'costeros', 'fenómenos costeros',
+             'niebla', 'ola de calor', 'helada', 'polvo en suspensión', 'aludes']
+SEVERITIES = ['Minor', 'Moderate', 'Severe', 'Extreme']
+ZONAS = ['litoral norte de {p}', 'meseta de {p}', 'zona de {p}', 'sector de {p}', 'área de {p}', 'campiña {p}',
+         'sistema ibérico de {p}', 'en {p}', '{p}']
+OFFSETS = ['', 'Z', '+01:00', '+0100', '-03:30', '+14:00', '-1200', '+5:00', '+01', '+01:000']
+
+
+def _rand_date(rng):
+    y = rng.choice(['2026', '1999', '0001', '9999', '2026'])
+    mo = rng.choice(['01', '12', '13', '00', '06'])
+    d = rng.choice(['01', '31', '29', '00', '15'])
+    h = rng.choice(['00', '23', '24', '12'])
+    return f'{y}-{mo}-{d}T{h}:{rng.choice(["00", "59", "60"])}:{rng.choice(["00", "59", "60"])}{rng.choice(OFFSETS)}'
+
+
+def generate_document(rng, n_infos=None):
+    """Genera un CAP sintético al estilo AEMET."""
+    infos = []
+    for _ in range(n_infos or rng.randint(1, 3)):
+        provincia = rng.choice(list(PROVINCIAS.values()) + ['Lisboa', 'Gironde', 'XX'])
+        nivel = rng.choice(NIVELES)
+        fenomeno = rng.choice(FENOMENOS)
+        infos.append(INFO_TEMPLATE.format(
+            fenomeno=fenomeno,
+            nivel=nivel,
+            severity=rng.choice(SEVERITIES),
+            onset=_rand_date(rng),
+            zona=rng.choice(ZONAS).format(p=provincia),
+            descripcion=rng.choice([
+                f'Alerta por {fenomeno} en {provincia}.',
+                f'Rachas máximas de 80 km/h; nivel {rng.randint(0, 9)}.',
+                f'Provincia {rng.choice(list(PROVINCIAS))} / código {rng.randint(0, 99):02d}',
+                '',
+            ]),
+            codigo=f'{rng.choice(list(PROVINCIAS))}{rng.randint(0, 9999):04d}',
+        ))
+    return CAP_TEMPLATE.format(ident=rng.randint(0, 10 ** 9), sent=_rand_date(rng), infos='\n'.join(infos))
+
+
+# --- mutadores: reciben (rng, texto) y devuelven texto ---
+
+def m_accents(rng, s):
+    table = {'a': 'á', 'e': 'é', 'i': 'í', 'o': 'ó', 'u': 'úü', 'n': 'ñ', 'A': 'Á', 'c': 'ç'}
+    out = []
+    for ch in s:
+        if ch in table and rng.random() < 0.15:
+            ch = rng.choice(table[ch])
+        out.append(ch)
+    s = ''.join(out)
+    return unicodedata.normalize(rng.choice(['NFC', 'NFD', 'NFKC', 'NFKD']), s)
+
+
+def m_mixed_encoding(rng, s):
+    # Texto latin1 decodificado como en el pipeline (utf-8 con fallback a latin1) -> mojibake
+    raw = s.encode(rng.choice(['latin1', 'cp1252', 'utf-8']), errors='replace')
+    if rng.random() < 0.5:
+        raw = raw.replace(b'\xc3', b'\xc3\xc3', 1)
+    return decode_bytes(raw)
+
+
+def m_case(rng, s):
+    return rng.choice([s.upper(), s.lower(), s.swapcase(), s.title()])
+
+
+def m_break_xml(rng, s):
+    ops = [
+        lambda t: t[:rng.randint(0, len(t))],
+        lambda t: t.replace('</info>', '', 1),
+        lambda t: t.replace('<', '&lt;', 1),
+        lambda t: t.replace('>', '', 1),
+        lambda t: t + '<extra>',
+        lambda t: t.replace('Aviso', 'Aviso & más', 1),
+        lambda t: t.replace('<info>', '<info><![CDATA[rojo ]]>', 1),
+        lambda t: t.replace('<info>', '<info>&#241;&#x1F300;&amp;', 1),
+        lambda t: t.replace('xmlns="urn:oasis:names:tc:emergency:cap:1.2"', '', 1),
+        lambda t: t.replace('<?xml version="1.0" encoding="UTF-8"?>', '﻿<?xml version="1.0"?>', 1),
+    ]
+    return rng.choice(ops)(s)
+
+
+def m_whitespace(rng, s):
+    return s.replace(' ', rng.choice(['  ', '\n', '\t', ' ', ' ']), rng.randint(1, 20))
+
+
+def m_inject(rng, s):
+    snippets = ['rojo', 'naranja', 'amarillo', 'nivel 4', 'costero', 'costeros', 'coster', 'por viento en',
+                ' 08 ', ' 51 ', ' 99 ', _rand_date(rng), 'meseta de soria', 'Álava', 'araba', 'a coruña', 'a',
+                'por\n', 'Por nevadas,', 'extremo']
+    pos = rng.randint(0, len(s))
+    return s[:pos] + ' ' + rng.choice(snippets) + ' ' + s[pos:]
+
+
+def m_huge(rng, s):
+    return generate_document(rng, n_infos=rng.randint(50, 400)) if rng.random() < 0.5 else s * rng.randint(2, 30)
+
+
+def m_junk(rng, s):
+    alphabet = 'abcñáé<>/&;:.,-+0123456789 \n\x00\x0b퟿�😀'
+    pos = rng.randint(0, len(s))
+    return s[:pos] + ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 40))) + s[pos:]
+
+
+MUTATORS = [m_accents, m_mixed_encoding, m_case, m_break_xml, m_whitespace, m_inject, m_huge, m_junk]
+
+
+def generate_inputs(rng, iterations, corpus=None):
+    """Genera documentos: semillas (sintéticas o del corpus) con 0-3 mutaciones."""
+    seeds = []
+    if corpus:
+        for path in sorted(Path(corpus).rglob('*')):
+            if path.is_file() and path.suffix.lower() in ('.xml', '.cap'):
+                seeds.append(decode_bytes(path.read_bytes()))
+    for _ in range(iterations):
+        doc = rng.choice(seeds) if seeds and rng.random() < 0.5 else generate_document(rng)
+        for mutate in rng.sample(MUTATORS, rng.randint(0, 3)):
+            doc = mutate(rng, doc)
+        yield doc
+
+
+def _call(fn, arg):
+    """Ejecuta `fn(arg)`; una excepción también es un resultado comparable."""
+    try:
+        return ('ok', fn(arg))
+    except Exception as e:
+        return ('error', type(e).__name__)
+
+
+def minimize(fn_a, fn_b, text, max_steps=2000):
+    """Reduce `text` (delta debugging sobre caracteres) manteniendo la divergencia."""
+    def diverges(t):
+        return _call(fn_a, t) != _call(fn_b, t)
+
+    chunk = max(len(text) // 2, 1)
+    steps = 0
+    while chunk >= 1 and steps < max_steps:
+        i = 0
+        reduced = False
+        while i < len(text) and steps < max_steps:
+            candidate = text[:i] + text[i + chunk:]
+            steps += 1
+            if diverges(candidate):
+                text = candidate
+                reduced = True
+            else:
+                i += chunk
+        if not reduced:
+            chunk //= 2
+    return text
+
+
+def load_candidate(spec: str):
+    if spec.endswith('.py'):
+        module_spec = importlib.util.spec_from_file_location('fuzz_candidate', spec)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+        return module
+    return importlib.import_module(spec)
+
+
+def run(candidate, iterations=1000, seed=0, corpus=None, out_dir=None, max_report=20):
+    rng = random.Random(seed)
+    pairs = {name: (getattr(alert_downloader, name), getattr(candidate, name))
+             for name in FUNCTIONS if hasattr(candidate, name)}
+    if not pairs:
+        print('La candidata no define ninguna de las funciones:', ', '.join(FUNCTIONS))
+        return 2
+
+    timings = {name: [0.0, 0.0, 0] for name in pairs}
+    divergences = []
+    seen = set()
+
+    def check(name, arg):
+        fn_a, fn_b = pairs[name]
+        # Alternar el orden para que cachés y calentamiento no favorezcan siempre al mismo lado
+        first_a = timings[name][2] % 2 == 0
+        t0 = time.perf_counter()
+        res_first = _call(fn_a if first_a else fn_b, arg)
+        t1 = time.perf_counter()
+        res_second = _call(fn_b if first_a else fn_a, arg)
+        t2 = time.perf_counter()
+        res_a, res_b = (res_first, res_second) if first_a else (res_second, res_first)
+        timings[name][0] += (t1 - t0) if first_a else (t2 - t1)
+        timings[name][1] += (t2 - t1) if first_a else (t1 - t0)
+        timings[name][2] += 1
+        if res_a != res_b:
+            divergences.append((name, arg, res_a, res_b))
+
+    for doc in generate_inputs(rng, iterations, corpus):
+        if 'extract_entries_from_xml' in pairs:
+            check('extract_entries_from_xml', doc)
+        # Las funciones de texto reciben las entradas que produce el parser actual y trozos crudos del documento
+        texts = alert_downloader.extract_entries_from_xml(doc) or [doc]
+        if len(doc) > 200:
+            start = rng.randint(0, len(doc) - 200)
+            texts.append(doc[start:start + rng.randint(1, 200)])
+        for text in texts:
+            for name in pairs:
+                if name not in DOCUMENT_FUNCTIONS:
+                    check(name, text)
+
+    print(f'{"función":28} {"llamadas":>9} {"actual (ms)":>12} {"candidata (ms)":>15} {"speedup":>8}')
+    for name, (t_a, t_b, n) in timings.items():
+        speedup = f'{t_a / t_b:.2f}x' if t_b else '-'
+        print(f'{name:28} {n:>9} {t_a * 1000:>12.1f} {t_b * 1000:>15.1f} {speedup:>8}')
+
+    if out_dir:
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+    # Una divergencia por forma (función, resultado actual, resultado candidata), la entrada más corta
+    shapes = {}
+    for name, arg, res_a, res_b in divergences:
+        key = (name, repr(res_a), repr(res_b))
+        if key not in shapes or len(arg) < len(shapes[key]):
+            shapes[key] = arg
+    by_function = {}
+    for (name, _, _), arg in shapes.items():
+        by_function.setdefault(name, []).append(arg)
+
+    # El presupuesto se reparte por turnos entre funciones: una que diverge mucho no tapa a las demás
+    reported = 0
+    numbers = {name: 0 for name in by_function}
+    queues = {name: iter(args) for name, args in by_function.items()}
+    while queues and reported < max_report:
+        for name in list(queues):
+            if reported >= max_report:
+                break
+            arg = next(queues[name], None)
+            if arg is None:
+                del queues[name]
+                continue
+            fn_a, fn_b = pairs[name]
+            small = minimize(fn_a, fn_b, arg)
+            res_a, res_b = repr(_call(fn_a, small)), repr(_call(fn_b, small))
+            # Entradas distintas suelen reducirse a la misma divergencia
+            if (name, res_a, res_b) in seen:
+                continue
+            seen.add((name, res_a, res_b))
+            reported += 1
+            numbers[name] += 1
+            repro = {'function': name, 'seed': seed, 'input': small, 'actual': res_a, 'candidata': res_b}
+            print(f"\n❌ Divergencia en {name}: {small!r}\n   actual:    {res_a}\n   candidata: {res_b}")
+            if out_dir:
+                with open(Path(out_dir) / f'{name}-{numbers[name]:03d}.json', 'w', encoding='utf-8') as f:
+                    json.dump(repro, f, ensure_ascii=False, indent=2)
+
+    if divergences:
+        print(f'\n{len(divergences)} divergencias, {len(shapes)} formas distintas ({reported} reproductores mostrados)')
+        return 1
+    print('\n✅ Sin divergencias')
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Differential fuzzing of the alert parsing functions')
+    parser.add_argument('--candidate', default='alert_downloader', help='Module name or .py file with the new implementation')
+    parser.add_argument('--iterations', type=int, default=1000, help='Number of generated documents')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus', help='Directory with real CAP/XML files used as seeds (e.g. data/alertas/current/extract)')
+    parser.add_argument('--out', help='Directory where minimized reproducers are written as JSON')
+    parser.add_argument('--max-report', type=int, default=20, help='Maximum number of minimized reproducers (shared round-robin between functions)')
+    args = parser.parse_args()
+    return run(load_candidate(args.candidate), args.iterations, args.seed, args.corpus, args.out, args.max_report)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
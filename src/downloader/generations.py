@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Generaciones de datos publicadas con un enlace simbólico `current`.
+
+Cada ejecución del pipeline trabaja en una generación nueva
+(`data/alertas/generations/<id>/`), creada como copia con hardlinks de la
+generación actual: las etapas que no cambian no copian datos, y las que sí
+cambian escriben ficheros nuevos (nunca modifican en sitio un fichero
+compartido). Al terminar, la generación se publica sustituyendo de forma
+atómica el enlace `data/alertas/current`.
+
+Los lectores (API Node, re-parseos manuales) resuelven `current` una sola vez
+y leen de esa generación, así que nunca ven datos a medio escribir ni
+bloquean al descargador. Las generaciones antiguas se eliminan con `gc()`,
+que respeta la actual, las más recientes y las que tienen un pin vigente.
+"""
+import fcntl
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from alert_downloader import DATA_DIR
+
+GENERATIONS_DIR = DATA_DIR / 'generations'
+CURRENT_LINK = DATA_DIR / 'current'
+GENERATIONS_KEEP = int(os.getenv('ALERTAS_GENERATIONS_KEEP', '3'))
+# Generaciones sin publicar más recientes que esto se consideran en construcción
+BUILD_GRACE_SECONDS = 3600
+# Un pin sin renovar durante más de esto se ignora (lector muerto)
+PIN_TTL_SECONDS = 3600
+BASE_FILE = '.base'
+PUBLISH_LOCK = GENERATIONS_DIR / '.publish_lock'
+
+
+def current_generation():
+    """Ruta de la generación publicada (resuelta una vez), o None si no hay."""
+    try:
+        target = os.readlink(CURRENT_LINK)
+    except OSError:
+        return None
+    path = (CURRENT_LINK.parent / target).resolve()
+    return path if path.is_dir() else None
+
+
+def new_generation() -> Path:
+    """Crea una generación de trabajo a partir de la actual (hardlinks) o vacía."""
+    GENERATIONS_DIR.mkdir(parents=True, exist_ok=True)
+    gen_id = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    gen = GENERATIONS_DIR / gen_id
+    with pin() as base:
+        if base is not None:
+            shutil.copytree(base, gen, copy_function=_link_or_copy, ignore=shutil.ignore_patterns('.pins', BASE_FILE))
+        else:
+            gen.mkdir()
+    # Generación de partida, para no publicar encima de otra publicada mientras tanto
+    (gen / BASE_FILE).write_text(base.name if base is not None else '', encoding='utf-8')
+    return gen
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+@contextmanager
+def publish_lock():
+    """Lock corto (flock) que serializa la comprobación y el cambio de `current`."""
+    GENERATIONS_DIR.mkdir(parents=True, exist_ok=True)
+    fd = os.open(str(PUBLISH_LOCK), os.O_CREAT | os.O_WRONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def publish(gen: Path) -> bool:
+    """Hace `gen` la generación actual sustituyendo el enlace `current` de forma atómica.
+
+    Si otra ejecución ha publicado desde que se creó `gen`, no se publica
+    (sus datos serían más antiguos o no incluirían los de la otra) y devuelve False.
+    """
+    try:
+        base = (gen / BASE_FILE).read_text(encoding='utf-8')
+    except OSError:
+        base = ''
+    with publish_lock():
+        current = current_generation()
+        if (current.name if current else '') != base:
+            print(f'⚠️  La generación actual cambió durante la ejecución; se descarta {gen.name}')
+            return False
+        tmp = CURRENT_LINK.with_name(f'.current-{os.getpid()}-{uuid.uuid4().hex[:8]}')
+        # Enlace relativo: sigue siendo válido aunque data/alertas se monte en otra ruta (contenedores)
+        os.symlink(os.path.relpath(gen, CURRENT_LINK.parent), tmp)
+        os.replace(tmp, CURRENT_LINK)
+    print(f'🔁 Generación publicada: {gen.name}')
+    return True
+
+
+def discard(gen: Path):
+    shutil.rmtree(gen, ignore_errors=True)
+
+
+@contextmanager
+def pin(gen: Path = None):
+    """Fija una generación (por defecto la actual) mientras dura el bloque.
+
+    Devuelve su ruta, o None si no hay generación publicada. Mientras el pin
+    exista, `gc()` no la elimina.
+    """
+    gen = gen or current_generation()
+    if gen is None:
+        yield None
+        return
+    pin_file = gen / '.pins' / f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+    try:
+        pin_file.parent.mkdir(exist_ok=True)
+        pin_file.touch()
+    except OSError:
+        pin_file = None
+    try:
+        yield gen
+    finally:
+        if pin_file is not None:
+            try:
+                pin_file.unlink()
+            except OSError:
+                pass
+
+
+def _pinned(gen: Path, now: float) -> bool:
+    try:
+        return any(now - p.stat().st_mtime < PIN_TTL_SECONDS for p in (gen / '.pins').iterdir())
+    except OSError:
+        return False
+
+
+def gc(keep: int = None):
+    """Elimina generaciones antiguas. Devuelve cuántas se eliminaron."""
+    keep = GENERATIONS_KEEP if keep is None else keep
+    if not GENERATIONS_DIR.exists():
+        return 0
+    now = time.time()
+    current = current_generation()
+    gens = sorted((p for p in GENERATIONS_DIR.iterdir() if p.is_dir()), key=lambda p: p.name)
+    recent = set(gens[-keep:]) if keep > 0 else set()
+    removed = 0
+    for gen in gens:
+        if gen == current or gen in recent or _pinned(gen, now):
+            continue
+        try:
+            if now - gen.stat().st_mtime < BUILD_GRACE_SECONDS and gen.name > (current.name if current else ''):
+                continue  # generación más nueva que la actual: probablemente aún en construcción
+        except OSError:
+            continue
+        discard(gen)
+        removed += 1
+    return removed
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""Avisos a los responsables de sede cuando su provincia entra en aviso.
+
+A partir de los avisos parseados (nivel más alto por región) se buscan las
+sedes de `data/sedes.csv` afectadas con nivel >= `ALERTAS_NOTIFY_MIN_LEVEL`,
+se agrupan por responsable (email/teléfono) y se envía un único mensaje por
+responsable con todas sus sedes.
+
+Para no repetir mensajes cuando AEMET reemite el mismo aviso se mantiene un
+registro de envíos (`data/alertas/notify/sent.json`): una sede ya avisada no
+se vuelve a notificar durante `ALERTAS_NOTIFY_WINDOW_HOURS` salvo que su
+nivel suba (naranja -> rojo). Solo se registran los envíos correctos, y cada
+ejecución envía como máximo `ALERTAS_NOTIFY_MAX_MESSAGES` mensajes.
+
+Canal de envío (`ALERTAS_NOTIFY`):
+  webhook:<url>   POST JSON (p.ej. pasarela SMS / chat)
+  smtp            correo vía SMTP_HOST/SMTP_PORT/SMTP_USER/SMTP_PASSWORD/SMTP_FROM
+  file:<ruta>     añade cada mensaje como una línea JSON (pruebas locales)
+  console         imprime los mensajes
+Si no se define, la etapa de notificación está desactivada.
+"""
+import csv
+import fcntl
+import json
+import os
+import smtplib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from pathlib import Path
+
+import requests
+
+from alert_downloader import DATA_DIR
+from sources import site_region
+
+NOTIFY_CHANNEL = os.getenv('ALERTAS_NOTIFY', '')
+NOTIFY_MIN_LEVEL = os.getenv('ALERTAS_NOTIFY_MIN_LEVEL', 'naranja')
+NOTIFY_WINDOW_HOURS = float(os.getenv('ALERTAS_NOTIFY_WINDOW_HOURS', '12'))
+NOTIFY_MAX_WORKERS = int(os.getenv('ALERTAS_NOTIFY_MAX_WORKERS', '4'))
+NOTIFY_MAX_MESSAGES = int(os.getenv('ALERTAS_NOTIFY_MAX_MESSAGES', '50'))
+SEDES_CSV = Path(os.getenv('ALERTAS_SEDES_CSV') or str(Path(__file__).resolve().parents[2] / 'data' / 'sedes.csv'))
+SEND_LOG = DATA_DIR / 'notify' / 'sent.json'
+SEND_LOCK = DATA_DIR / 'notify' / '.send_lock'
+
+NIVELES_ORDEN = {'verde': 0, 'amarillo': 1, 'naranja': 2, 'rojo': 3}
+
+
+class WebhookSender:
+    """Envía cada mensaje como JSON a una URL."""
+
+    def __init__(self, url: str, timeout: int = 15):
+        self.url = url
+        self.timeout = timeout
+
+    def can_reach(self, contact: dict) -> bool:
+        return True
+
+    def send(self, message: dict):
+        resp = requests.post(self.url, json=message, timeout=self.timeout)
+        resp.raise_for_status()
+
+
+class SmtpSender:
+    """Envía cada mensaje por correo al email del responsable."""
+
+    def __init__(self, host: str, port: int = 587, user: str = None, password: str = None, sender: str = None):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.sender = sender or user
+
+    def can_reach(self, contact: dict) -> bool:
+        """Solo los responsables con email; los que solo tienen teléfono no se pueden avisar por correo."""
+        return bool(contact.get('email'))
+
+    def send(self, message: dict):
+        if not message.get('email'):
+            raise ValueError('el responsable no tiene email')
+        mail = EmailMessage()
+        mail['Subject'] = message['subject']
+        mail['From'] = self.sender
+        mail['To'] = message['email']
+        mail.set_content(message['text'])
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            smtp.starttls()
+            if self.user:
+                smtp.login(self.user, self.password)
+            smtp.send_message(mail)
+
+
+class FileSender:
+    """Añade cada mensaje como línea JSON a un fichero (sustituto local para pruebas)."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def can_reach(self, contact: dict) -> bool:
+        return True
+
+    def send(self, message: dict):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(message, ensure_ascii=False) + '\n')
+
+
+class ConsoleSender:
+    def can_reach(self, contact: dict) -> bool:
+        return True
+
+    def send(self, message: dict):
+        print(f"📣 {message['subject']}\n{message['text']}")
+
+
+def configured_sender(spec: str = None):
+    """Construye el canal indicado en `spec` (por defecto `ALERTAS_NOTIFY`), o None si no hay."""
+    spec = (NOTIFY_CHANNEL if spec is None else spec).strip()
+    if not spec:
+        return None
+    if spec.startswith('webhook:'):
+        return WebhookSender(spec.split(':', 1)[1])
+    if spec == 'smtp':
+        return SmtpSender(os.getenv('SMTP_HOST', 'localhost'), int(os.getenv('SMTP_PORT', '587')),
+                          os.getenv('SMTP_USER'), os.getenv('SMTP_PASSWORD'), os.getenv('SMTP_FROM'))
+    if spec.startswith('file:'):
+        return FileSender(spec.split(':', 1)[1])
+    if spec == 'console':
+        return ConsoleSender()
+    print(f'⚠️  Canal de notificación desconocido: {spec}')
+    return None
+
+
+def load_sites(path: Path = None):
+    """Lee las sedes con su responsable y la región con la que se cruzan con los avisos."""
+    sites = []
+    with open(path or SEDES_CSV, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            sites.append({
+                'nombre': (row.get('nombre') or '').strip(),
+                # Misma regla que la API Node (columnas `region` / `pais`, ver sources.site_region)
+                'region': site_region(row.get('codigo_postal'), row.get('pais'), row.get('region')),
+                'responsable': (row.get('responsable_nombre') or '').strip(),
+                'email': (row.get('responsable_email') or '').strip(),
+                'telefono': (row.get('responsable_telefono') or '').strip(),
+            })
+    return sites
+
+
+def affected_sites_by_contact(alertas_por_provincia: dict, sites, min_level: str = None, sender=None):
+    """Agrupa por responsable las sedes cuya región tiene un aviso >= `min_level`.
+
+    Con `sender` se descartan los responsables a los que ese canal no puede
+    llegar (`sender.can_reach`, p.ej. sin email para smtp): se avisa una vez
+    por ejecución y no cuentan como pendientes, porque reintentar no sirve.
+    """
+    threshold = NIVELES_ORDEN[min_level or NOTIFY_MIN_LEVEL]
+    grouped = {}
+    unreachable = {}
+    for site in sites:
+        alerta = alertas_por_provincia.get(site['region']) if site['region'] else None
+        if not alerta or NIVELES_ORDEN.get(alerta['nivel'], 0) < threshold:
+            continue
+        contact = site['email'] or site['telefono']
+        if not contact:
+            print(f"⚠️  Sede {site['nombre']} en aviso {alerta['nivel']} sin responsable de contacto")
+            continue
+        if sender is not None and not sender.can_reach(site):
+            unreachable.setdefault(contact, []).append(site['nombre'])
+            continue
+        entry = grouped.setdefault(contact, {
+            'responsable': site['responsable'],
+            'email': site['email'],
+            'telefono': site['telefono'],
+            'sedes': [],
+        })
+        entry['sedes'].append({
+            'nombre': site['nombre'],
+            'provincia': alerta.get('nombre') or '',
+            'nivel': alerta['nivel'],
+            'fenomeno': alerta.get('fenomeno') or '',
+        })
+    if unreachable:
+        sedes = sum(len(v) for v in unreachable.values())
+        print(f"⚠️  {len(unreachable)} responsable(s) sin contacto válido para el canal {type(sender).__name__} "
+              f"({sedes} sede(s) en aviso no notificadas): {', '.join(sorted(unreachable))}")
+    return grouped
+
+
+@contextmanager
+def send_lock():
+    """Serializa (flock) la lectura, los envíos y la escritura del registro entre procesos."""
+    SEND_LOCK.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(str(SEND_LOCK), os.O_CREAT | os.O_WRONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def load_send_log() -> dict:
+    try:
+        with open(SEND_LOG, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_send_log(log: dict):
+    SEND_LOG.parent.mkdir(parents=True, exist_ok=True)
+    tmp = SEND_LOG.with_name(SEND_LOG.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(log, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, SEND_LOG)
+
+
+def pending_messages(grouped: dict, log: dict, now: datetime = None):
+    """Construye un mensaje por responsable con las sedes nuevas o que suben de nivel."""
+    now = now or datetime.utcnow()
+    window = timedelta(hours=NOTIFY_WINDOW_HOURS)
+    messages = []
+    for contact, entry in sorted(grouped.items()):
+        sent = log.get(contact, {})
+        nuevas = []
+        for sede in entry['sedes']:
+            prev = sent.get(sede['nombre'])
+            if prev:
+                reciente = now - datetime.fromisoformat(prev['sent']) < window
+                sube = NIVELES_ORDEN.get(sede['nivel'], 0) > NIVELES_ORDEN.get(prev['nivel'], 0)
+                if reciente and not sube:
+                    continue
+            nuevas.append(sede)
+        if not nuevas:
+            continue
+        peor = max(nuevas, key=lambda s: NIVELES_ORDEN.get(s['nivel'], 0))['nivel']
+        lineas = [f"- {s['nombre']} ({s['provincia']}): aviso {s['nivel']}" + (f" por {s['fenomeno']}" if s['fenomeno'] else '')
+                  for s in nuevas]
+        messages.append({
+            'contact': contact,
+            'responsable': entry['responsable'],
+            'email': entry['email'],
+            'telefono': entry['telefono'],
+            'nivel': peor,
+            'sedes': nuevas,
+            'subject': f"Aviso meteorológico {peor} en {len(nuevas)} sede(s)",
+            'text': f"Hola {entry['responsable']},\n\nSedes a tu cargo en aviso meteorológico:\n" + '\n'.join(lineas),
+        })
+    return messages
+
+
+def _send_one(sender, message):
+    try:
+        sender.send(message)
+        return True
+    except Exception as e:
+        print(f"❌ Error notificando a {message['contact']}: {e}")
+        return False
+
+
+def notify(alertas_por_provincia: dict, sender=None, sites=None, now: datetime = None):
+    """Envía los mensajes pendientes y actualiza el registro de envíos.
+
+    Devuelve `(enviados, pendientes)`: pendientes son los mensajes que fallaron
+    o que quedaron fuera por `NOTIFY_MAX_MESSAGES` y deben reintentarse.
+    """
+    sender = sender or configured_sender()
+    if sender is None:
+        return 0, 0
+    now = now or datetime.utcnow()
+    sites = load_sites() if sites is None else sites
+    grouped = affected_sites_by_contact(alertas_por_provincia, sites, sender=sender)
+
+    # Dos ejecuciones a la vez no deben leer el mismo registro y repetir los envíos
+    with send_lock():
+        return _notify_locked(grouped, sender, now)
+
+
+def _notify_locked(grouped: dict, sender, now: datetime):
+    log = load_send_log()
+    # Olvidar sedes que ya no están en aviso y cuya ventana ha expirado
+    window = timedelta(hours=NOTIFY_WINDOW_HOURS)
+    for contact in list(log):
+        activas = {s['nombre'] for s in grouped.get(contact, {}).get('sedes', [])}
+        log[contact] = {nombre: prev for nombre, prev in log[contact].items()
+                        if nombre in activas or now - datetime.fromisoformat(prev['sent']) < window}
+        if not log[contact]:
+            del log[contact]
+
+    messages = pending_messages(grouped, log, now)
+    pending = max(len(messages) - NOTIFY_MAX_MESSAGES, 0)
+    if pending:
+        print(f'⚠️  {len(messages)} notificaciones pendientes; se envían {NOTIFY_MAX_MESSAGES} y el resto en la siguiente ejecución')
+        messages = messages[:NOTIFY_MAX_MESSAGES]
+
+    sent = 0
+    if messages:
+        with ThreadPoolExecutor(max_workers=NOTIFY_MAX_WORKERS) as ex:
+            results = list(ex.map(lambda m: _send_one(sender, m), messages))
+        for message, ok in zip(messages, results):
+            if not ok:
+                pending += 1
+                continue
+            sent += 1
+            for sede in message['sedes']:
+                log.setdefault(message['contact'], {})[sede['nombre']] = {'nivel': sede['nivel'], 'sent': now.isoformat()}
+        print(f'📣 Notificaciones enviadas: {sent}/{len(messages)}')
+    save_send_log(log)
+    return sent, pending
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""Pipeline de avisos por etapas: fetch -> extract -> parse -> publish -> notify.
+
+Usage:
+  python3 src/downloader/pipeline.py run [--force]
+  python3 src/downloader/pipeline.py fetch
+  python3 src/downloader/pipeline.py extract [--force]
+  python3 src/downloader/pipeline.py parse [--force]
+  python3 src/downloader/pipeline.py publish [--force]
+  python3 src/downloader/pipeline.py notify [--force]
+  python3 src/downloader/pipeline.py status
+
+La descarga raw se guarda en `data/alertas/stages/fetch/<fuente>` (checkpoint
+en `stages/state.json`). El resto de etapas escriben en una generación nueva
+(`data/alertas/generations/<id>/`, ver generations.py) con su propio
+`state.json` que guarda el hash de las entradas y de la salida de cada etapa:
+
+  fetch    -> stages/fetch/<fuente>     datos raw descargados (+ archivo raw)
+  extract  -> <gen>/extract/<fuente>    documentos CAP extraídos
+  parse    -> <gen>/parse/records.json  filas de avisos
+  publish  -> <gen>/alertas-*.csv       CSV para la API Node.js
+  notify   -> data/alertas/notify/      mensajes a responsables de sede (ver notifier.py)
+
+Si las entradas de una etapa no han cambiado desde su última ejecución, la
+etapa se omite (`--force` la repite). Las entradas de parse y publish incluyen
+el hash del código que las implementa, de modo que un cambio en los detectores
+invalida el parseo y un cambio de formato solo repite la publicación.
+
+Solo fetch y extract se ejecutan con el lock de descarga. Al terminar, la
+generación se publica cambiando `data/alertas/current`; si ninguna etapa ha
+cambiado nada se descarta. Los lectores nunca ven una generación a medias.
+Tras publicar, los CSV de la generación actual se copian a `data/` (respaldo
+de la API) y notify se ejecuta sobre ella, con su checkpoint en
+`notify/state.json`: una generación descartada nunca envía mensajes.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[0]))
+import alert_downloader
+import archive_store
+import csv_output
+import generations
+import notifier
+import sources as sources_mod
+from alert_downloader import (
+    DATA_DIR,
+    acquire_lock,
+    alert_records_from_file,
+    clean_debug,
+    collect_raw_rows,
+    ensure_data_dir,
+    release_lock,
+)
+from sources import configured_sources, fetch_sources, source_by_name
+
+STAGES_DIR = DATA_DIR / 'stages'
+STATE_FILE = STAGES_DIR / 'state.json'
+STATE_NAME = 'state.json'
+NOTIFY_STATE_FILE = DATA_DIR / 'notify' / 'state.json'
+RECORDS_NAME = Path('parse') / 'records.json'
+STAGES = ('fetch', 'extract', 'parse', 'publish', 'notify')
+LOCKED_STAGES = ('fetch', 'extract')
+
+
+def file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def tree_digest(path: Path) -> str:
+    """Hash de un fichero, o de una carpeta (rutas relativas + hash de cada fichero)."""
+    if path.is_file():
+        return file_digest(path)
+    h = hashlib.sha256()
+    for f in sorted(p for p in path.rglob('*') if p.is_file() and p.suffix != '.part'):
+        h.update(f.relative_to(path).as_posix().encode('utf-8') + b'\0')
+        h.update(file_digest(f).encode('ascii'))
+    return h.hexdigest()
+
+
+def _code_digest(*modules) -> str:
+    h = hashlib.sha256()
+    for m in modules:
+        h.update(Path(m.__file__).read_bytes())
+    return h.hexdigest()
+
+
+def _combine(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_state(path: Path = STATE_FILE) -> dict:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state: dict, path: Path = STATE_FILE):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _fingerprint(state: dict) -> dict:
+    """Estado sin las horas de ejecución: si coincide con el de la generación actual no hay nada nuevo que publicar."""
+    return {stage: {k: v for k, v in info.items() if k != 'finished'} for stage, info in state.items()}
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat()
+
+
+def stage_fetch(sources=None) -> bool:
+    """Descarga las fuentes (en paralelo) y archiva los datos raw nuevos."""
+    sources = configured_sources() if sources is None else sources
+    fetched = fetch_sources(sources, STAGES_DIR / 'fetch')
+    if not fetched:
+        print('❌ No se pudo descargar ninguna fuente de avisos')
+        return False
+
+    state = load_state()
+    # Las fuentes que fallan en esta ejecución conservan su última descarga correcta
+    configured = {s.name for s in sources}
+    previous = state.get('fetch', {}).get('outputs', {})
+    outputs = {name: out for name, out in previous.items() if name in configured}
+    for source, raw in fetched:
+        digest = tree_digest(raw)
+        old = previous.get(source.name)
+        run_id = old.get('run_id') if old and old['digest'] == digest else None
+        if archive_store.ARCHIVE_ENABLED and not run_id:
+            try:
+                if raw.is_file():
+                    run_id = archive_store.store_package(raw, source=source.name)
+                else:
+                    run_id = archive_store.store_directory(raw, source=source.name)
+            except Exception as e:
+                print(f'⚠️  No se pudo archivar {source.name}: {e}')
+        outputs[source.name] = {'raw': str(raw), 'digest': digest, 'run_id': run_id}
+
+    state['fetch'] = {'outputs': outputs, 'finished': _now()}
+    save_state(state)
+
+    # Retención del archivo raw (manifiestos antiguos y objetos sin referencia)
+    if archive_store.ARCHIVE_ENABLED:
+        try:
+            archive_store.gc()
+        except Exception as e:
+            print('⚠️  Error en la limpieza del archivo raw:', e)
+    return True
+
+
+def stage_extract(gen: Path, force: bool = False) -> bool:
+    """Extrae en la generación los documentos CAP de cada fuente cuya descarga ha cambiado."""
+    fetch = load_state().get('fetch')
+    if not fetch:
+        print('⚠️  No hay datos de la etapa fetch; ejecuta primero `fetch`')
+        return False
+
+    state = load_state(gen / STATE_NAME)
+    previous = state.get('extract', {}).get('outputs', {})
+    outputs = {}
+    for name, out in fetch['outputs'].items():
+        dest = gen / 'extract' / name
+        old = previous.get(name)
+        if not force and old and old['input'] == out['digest'] and dest.exists():
+            print(f'⏭️  extract ({name}): sin cambios, se omite')
+            outputs[name] = old
+            continue
+        # La carpeta heredada son hardlinks de la generación anterior: se sustituye entera,
+        # nunca se sobrescriben sus ficheros
+        shutil.rmtree(dest, ignore_errors=True)
+        if not source_by_name(name).extract(Path(out['raw']), dest):
+            continue
+        outputs[name] = {'input': out['digest'], 'digest': tree_digest(dest)}
+
+    if not outputs:
+        print('❌ No se pudo extraer ninguna fuente de avisos')
+        return False
+    state['extract'] = {'outputs': outputs, 'finished': _now()}
+    save_state(state, gen / STATE_NAME)
+    return True
+
+
+def stage_parse(gen: Path, force: bool = False) -> bool:
+    """Parsea los documentos extraídos de todas las fuentes en `records.json`."""
+    state = load_state(gen / STATE_NAME)
+    records_file = gen / RECORDS_NAME
+    extract = state.get('extract')
+    if not extract:
+        print('⚠️  No hay datos de la etapa extract; ejecuta primero `extract`')
+        return False
+
+    inputs = _combine({name: out['digest'] for name, out in extract['outputs'].items()},
+                      _code_digest(alert_downloader, sources_mod))
+    previous = state.get('parse', {})
+    if not force and previous.get('input') == inputs and records_file.exists():
+        print('⏭️  parse: sin cambios, se omite')
+        return True
+
+    parsers = {name: source_by_name(name) for name in extract['outputs']}
+    documents = (
+        (name, fpath, alert_records_from_file(fpath, parsers[name].parse))
+        for name, out in extract['outputs'].items()
+        for fpath in parsers[name].documents(gen / 'extract' / name)
+    )
+    rows, alertas_por_provincia = collect_raw_rows(documents)
+    if not rows:
+        print('⚠️  No se encontraron alertas (raw) tras procesar XMLs')
+
+    records_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = records_file.with_name(records_file.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'rows': rows, 'alertas_por_provincia': alertas_por_provincia}, f, ensure_ascii=False)
+    os.replace(tmp, records_file)
+
+    state['parse'] = {'input': inputs, 'digest': file_digest(records_file), 'rows': len(rows), 'finished': _now()}
+    save_state(state, gen / STATE_NAME)
+    return True
+
+
+def stage_publish(gen: Path, force: bool = False) -> bool:
+    """Escribe los CSV de alertas de la generación a partir de `records.json`."""
+    state = load_state(gen / STATE_NAME)
+    records_file = gen / RECORDS_NAME
+    parse = state.get('parse')
+    if not parse or not records_file.exists():
+        print('⚠️  No hay datos de la etapa parse; ejecuta primero `parse`')
+        return False
+
+    inputs = _combine(parse['digest'], _code_digest(csv_output))
+    previous = state.get('publish', {})
+    if not force and previous.get('input') == inputs:
+        print('⏭️  publish: sin cambios, se omite')
+        return True
+
+    with open(records_file, 'r', encoding='utf-8') as f:
+        records = json.load(f)
+    # Sin alertas también se escriben (solo cabecera): los avisos que expiran deben desaparecer
+    csv_output.write_raw_csv(records['rows'], records['alertas_por_provincia'], out_dir=gen)
+
+    state['publish'] = {'input': inputs, 'finished': _now()}
+    save_state(state, gen / STATE_NAME)
+    return True
+
+
+def stage_notify(gen: Path, force: bool = False) -> bool:
+    """Notifica a los responsables de las sedes que entran en aviso según la generación `gen` (publicada).
+
+    Los errores (p.ej. sedes.csv ausente) se registran y devuelven False sin
+    interrumpir el pipeline. El checkpoint es global (`notify/state.json`,
+    como el registro de envíos) y solo se guarda si no queda ningún mensaje
+    pendiente o fallido, para que la siguiente ejecución lo reintente aunque
+    los avisos no hayan cambiado.
+    """
+    sender = notifier.configured_sender()
+    if sender is None:
+        return True
+    records_file = gen / RECORDS_NAME
+    parse = load_state(gen / STATE_NAME).get('parse')
+    if not parse or not records_file.exists():
+        print('⚠️  No hay datos de la etapa parse; ejecuta primero `parse`')
+        return False
+
+    try:
+        inputs = _combine(parse['digest'], file_digest(notifier.SEDES_CSV), _code_digest(notifier, sources_mod))
+        if not force and load_state(NOTIFY_STATE_FILE).get('input') == inputs:
+            print('⏭️  notify: sin cambios, se omite')
+            return True
+
+        with open(records_file, 'r', encoding='utf-8') as f:
+            records = json.load(f)
+        # El registro de envíos evita repetir mensajes aunque la etapa se repita
+        _, pending = notifier.notify(records['alertas_por_provincia'], sender=sender)
+    except Exception as e:
+        print('❌ Error en la etapa notify:', e)
+        return False
+    if pending:
+        print(f'⚠️  notify: {pending} mensaje(s) pendientes, se reintentarán en la siguiente ejecución')
+        return True
+
+    save_state({'input': inputs, 'generation': gen.name, 'finished': _now()}, NOTIFY_STATE_FILE)
+    return True
+
+
+def _run_locked(gen: Path, stages, sources, force: bool) -> int:
+    if 'fetch' in stages:
+        clean_debug()
+        if not stage_fetch(sources):
+            return 3
+    if 'extract' in stages and not stage_extract(gen, force):
+        return 3
+    return 0
+
+
+def _run_unlocked(gen: Path, stages, force: bool) -> int:
+    if 'parse' in stages and not stage_parse(gen, force):
+        return 5
+    if 'publish' in stages and not stage_publish(gen, force):
+        return 5
+    return 0
+
+
+def _build_generation(stages, sources, force: bool):
+    """Ejecuta las etapas de construcción en una generación nueva y la publica.
+
+    Devuelve `(código, vigente)`: `vigente` indica que `current` refleja esta
+    ejecución (se publicó, o no había cambios). Es False si no se ejecutó por
+    el lock o si otra ejecución publicó antes (sus datos ganan).
+    """
+    locked = any(stage in LOCKED_STAGES for stage in stages)
+    if locked and not acquire_lock():
+        print('⏳ Otra instancia en ejecución. Se omite esta ejecución.')
+        return 0, False
+    gen = None
+    try:
+        gen = generations.new_generation()
+        code = _run_locked(gen, stages, sources, force)
+        if locked:
+            release_lock()
+            locked = False
+        if code == 0:
+            code = _run_unlocked(gen, stages, force)
+    except BaseException:
+        if gen is not None:
+            generations.discard(gen)
+        raise
+    finally:
+        if locked:
+            release_lock()
+
+    if code != 0:
+        generations.discard(gen)
+        return code, False
+    current = generations.current_generation()
+    if current is not None and _fingerprint(load_state(gen / STATE_NAME)) == _fingerprint(load_state(current / STATE_NAME)):
+        print('⏭️  Sin cambios, no se publica una generación nueva')
+        generations.discard(gen)
+        return 0, True
+    if not generations.publish(gen):
+        generations.discard(gen)
+        return 0, False
+    return 0, True
+
+
+def run_pipeline(sources=None, force: bool = False, stages=STAGES) -> int:
+    """Ejecuta `stages` en una generación nueva y la publica. Devuelve un código de salida como `fetch_json`.
+
+    Solo fetch y extract se hacen con el lock de descarga; parse y publish
+    trabajan en la generación propia y pueden solaparse con otras ejecuciones
+    y con los lectores. notify solo se ejecuta sobre la generación publicada.
+    """
+    build = tuple(stage for stage in stages if stage != 'notify')
+    code, vigente = _build_generation(build, sources, force) if build else (0, True)
+
+    if code == 0 and vigente:
+        with generations.publish_lock():
+            current = generations.current_generation()
+            # Copia en data/ para la API Node sin generaciones, siempre desde lo publicado
+            if current is not None and build:
+                csv_output.mirror_to_legacy(current)
+        if 'notify' in stages:
+            with generations.pin() as current:
+                # Un fallo al notificar no invalida los CSV ya publicados
+                if current is not None and not stage_notify(current, force) and stages == ('notify',):
+                    code = 1
+    generations.gc()
+    return code
+
+
+def print_status():
+    fetch = load_state().get('fetch')
+    current = generations.current_generation()
+    state = load_state(current / STATE_NAME) if current else {}
+    if fetch:
+        state['fetch'] = fetch
+    state['notify'] = load_state(NOTIFY_STATE_FILE)
+    print(f"current  {current.name if current else '-'}")
+    for stage in STAGES:
+        info = state.get(stage)
+        if not info:
+            print(f'{stage:8} -')
+            continue
+        detail = ', '.join(sorted(info.get('outputs', {}))) or (info.get('input') or '')[:12]
+        print(f"{stage:8} {info.get('finished', '?')}  {detail}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pipeline de avisos por etapas')
+    parser.add_argument('stage', choices=STAGES + ('run', 'status'))
+    parser.add_argument('--force', action='store_true', help='Re-run the stage even if its inputs did not change')
+    args = parser.parse_args()
+
+    if args.stage == 'status':
+        print_status()
+        return 0
+
+    ensure_data_dir()
+    code = run_pipeline(force=args.force, stages=STAGES if args.stage == 'run' else (args.stage,))
+    if args.stage != 'run' and code:
+        return 1
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,59 +2,112 @@
 """Run raw alert parser (moved to src/downloader).
 
 Usage:
-  python3 src/downloader/run_raw_parser.py [--tmpdir PATH] [--verbose]
+  python3 src/downloader/run_raw_parser.py [--tmpdir PATH | --run RUN_ID|latest] [--source NAME] [--out DIR] [--verbose]
 
-If --tmpdir is not provided, the script uses `data/alertas/tmp` and selects
-the most recent subdirectory. --verbose prints a short sample analysis before
+Without --tmpdir/--run the current data is re-parsed through the pipeline
+(`pipeline.py parse --force` + `publish`): every source of the current
+generation is parsed again and, if the result changed, a new generation is
+published, so the API sees it.
+
+--tmpdir re-parses an arbitrary folder of extracted documents and --run a
+package rebuilt from the raw archive (see archive_store.py). Both use the
+parser of --source (default `aemet`; `meteoalarm-<pais>` for MeteoAlarm)
+and write the CSVs to --out (default `data/alertas/reparse`), leaving the
+published data untouched. --verbose prints a short sample analysis before
 writing the full raw CSV.
 """
 from pathlib import Path
 import sys
 import argparse
+import shutil
+import tempfile
 sys.path.insert(0, str(Path(__file__).resolve().parents[0]))
 import importlib
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--tmpdir', help='Path to tmp directory containing extracted XMLs', default='data/alertas/tmp')
+    parser.add_argument('--tmpdir', help='Path to a directory containing extracted XMLs')
+    parser.add_argument('--source', help='Source whose parser is used (and subdirectory inside tmpdir)', default='aemet')
+    parser.add_argument('--run', help='Archived run id to re-parse (or "latest" for the source)')
+    parser.add_argument('--out', help='Output directory for --tmpdir/--run (default: data/alertas/reparse)')
     parser.add_argument('--verbose', action='store_true', help='Show sample counts before producing CSV')
     args = parser.parse_args()
 
     fetch_json = importlib.reload(__import__('alert_downloader'))
+    import generations
+    from sources import source_by_name
+
+    try:
+        source = source_by_name(args.source)
+    except ValueError as e:
+        print(e)
+        return 2
+
+    if not args.tmpdir and not args.run:
+        if args.verbose:
+            with generations.pin() as gen:
+                if gen is not None:
+                    sample(source, gen / 'extract' / source.name)
+        import pipeline
+        return pipeline.run_pipeline(force=True, stages=('parse', 'publish'))
+
+    out_dir = Path(args.out) if args.out else fetch_json.DATA_DIR / 'reparse'
+    if args.tmpdir:
+        return reparse(fetch_json, source, Path(args.tmpdir), out_dir, args.verbose)
+
+    import archive_store
+    run_id = archive_store.latest_run(source.name) if args.run == 'latest' else args.run
+    if not run_id:
+        print('No archived runs for source', source.name)
+        return 2
+    data_tmp = Path(tempfile.mkdtemp(prefix='alertas-run-'))
+    try:
+        archive_store.extract_run(run_id, data_tmp)
+        print('Using archived run:', run_id)
+        return reparse(fetch_json, source, data_tmp, out_dir, args.verbose)
+    finally:
+        shutil.rmtree(data_tmp, ignore_errors=True)
+
+
+def sample(source, data_dir: Path):
+    files = source.documents(data_dir)
+    print('XML files count:', len(files))
+    rows = 0
+    for f in files[:50]:
+        try:
+            text = Path(f).read_text(errors='ignore')
+        except Exception:
+            continue
+        rows += sum(1 for _ in source.parse(text))
+    print('Found rows (sample first 50 files):', rows)
 
-    data_tmp = Path(args.tmpdir)
-    if not data_tmp.exists():
-        print('No tmp directory found at', data_tmp)
+
+def reparse(fetch_json, source, data_dir: Path, out_dir: Path, verbose: bool = False):
+    import csv_output
+
+    if not data_dir.exists():
+        print('No tmp directory found at', data_dir)
         return 2
+    if (data_dir / source.name).is_dir():
+        data_dir = data_dir / source.name
+    print('Using tmp:', data_dir)
+
+    if verbose:
+        sample(source, data_dir)
 
-    subs = sorted([p for p in data_tmp.iterdir() if p.is_dir()], reverse=True)
-    if not subs:
-        print('No subdirectories in', data_tmp)
+    files = source.documents(data_dir)
+    if not files:
+        print('No XML/CAP documents in', data_dir)
         return 1
-    latest = subs[0]
-    print('Using tmp:', latest)
-
-    if args.verbose:
-        from alert_downloader import extract_entries_from_xml, detect_level
-        files = list(latest.rglob('*.xml'))
-        print('XML files count:', len(files))
-        rows = 0
-        for f in files[:50]:
-            try:
-                text = f.read_text(errors='ignore')
-            except Exception:
-                continue
-            entries = extract_entries_from_xml(text)
-            for e in entries:
-                nivel = detect_level(e)
-                if nivel == 'verde':
-                    continue
-                rows += 1
-        print('Found rows (sample first 50 files):', rows)
-
-    fetch_json.parse_tmp_and_write_raw_csv(latest)
+    documents = ((source.name, f, fetch_json.alert_records_from_file(f, source.parse)) for f in files)
+    rows, alertas_por_provincia = fetch_json.collect_raw_rows(documents)
+    if not rows:
+        print('⚠️  No se encontraron alertas (raw) tras procesar XMLs')
+        return 0
+    csv_output.write_raw_csv(rows, alertas_por_provincia, out_dir=out_dir)
     print('done')
+    return 0
 
 
 if __name__ == '__main__':
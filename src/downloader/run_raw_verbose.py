@@ -1,31 +1,39 @@
 #!/usr/bin/env python3
+"""Análisis rápido de los documentos publicados y re-parseo por el pipeline.
+
+Usage:
+  python3 src/downloader/run_raw_verbose.py
+
+Cuenta los documentos y avisos (muestra de 50 ficheros) de cada fuente de la
+generación actual, fijada mientras se lee, y después re-parsea y publica como
+`run_raw_parser.py` sin argumentos (`parse --force` + `publish`).
+"""
 from pathlib import Path
 import sys
 sys.path.insert(0, str(Path(__file__).resolve().parents[0]))
-import importlib
-fetch_json = importlib.reload(__import__('alert_downloader'))
-from alert_downloader import extract_entries_from_xml, detect_level, detect_province, detect_phenomenon
 
-p = Path('data/alertas/tmp')
-subs = sorted([d for d in p.iterdir() if d.is_dir()], reverse=True)
-print('subs:', subs[:5])
-if not subs:
-    print('no tmp')
-    sys.exit(1)
-latest = subs[0]
-print('latest:', latest)
-files = list(latest.rglob('*.xml'))
-print('xml files count:', len(files))
-rows = 0
-for f in files[:50]:
-    text = f.read_text(errors='ignore')
-    entries = extract_entries_from_xml(text)
-    for e in entries:
-        nivel = detect_level(e)
-        if nivel=='verde':
-            continue
-        rows += 1
-print('found rows (sample first 50 files):', rows)
-# run the real function
-fetch_json.parse_tmp_and_write_raw_csv(latest)
-print('done')
+import generations
+import pipeline
+from run_raw_parser import sample
+from sources import source_by_name
+
+
+def main():
+    with generations.pin() as gen:
+        extract_dir = gen / 'extract' if gen is not None else None
+        if extract_dir is None or not extract_dir.is_dir():
+            print('No published generation with extracted documents')
+            return 1
+        for d in sorted(p for p in extract_dir.iterdir() if p.is_dir()):
+            try:
+                source = source_by_name(d.name)
+            except ValueError as e:
+                print(e)
+                continue
+            print('source:', source.name)
+            sample(source, d)
+    return pipeline.run_pipeline(force=True, stages=('parse', 'publish'))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
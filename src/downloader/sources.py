@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""Adaptadores de fuentes de avisos CAP.
+
+Cada fuente sabe descargar sus datos raw, extraer de ellos los documentos CAP,
+enumerarlos y mapear sus áreas a regiones (código, nombre). Las fuentes se
+descargan en paralelo y sus avisos pasan por el mismo pipeline de parseo y
+publicación (ver `pipeline.py`).
+
+Fuentes disponibles (variable `ALERTAS_SOURCES`, separadas por comas):
+  aemet                 -> API OpenData de AEMET (requiere AEMET_API_KEY)
+  meteoalarm:<pais>     -> feed Atom/CAP de MeteoAlarm, p.ej. meteoalarm:portugal
+
+La URL del feed de MeteoAlarm se construye con `METEOALARM_FEED_URL`
+(plantilla con `{country}`). Admite rutas locales o `file://`, lo que permite
+probar el pipeline contra feeds de ejemplo sin red.
+"""
+import os
+import re
+import shutil
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urljoin, urlparse, unquote
+
+import requests
+
+import alert_downloader
+from alert_downloader import (
+    alert_records_from_text,
+    download_file,
+    extract_tar,
+    fetch_aemet_datos_url,
+    find_cap_files,
+    node_province_region,
+)
+
+ALERTAS_SOURCES = os.getenv('ALERTAS_SOURCES', 'aemet')
+METEOALARM_FEED_URL = os.getenv('METEOALARM_FEED_URL') or 'https://feeds.meteoalarm.org/feeds/meteoalarm-legacy-atom-{country}'
+# Máximo de documentos CAP enlazados que se descargan por feed (el resto se parsea desde el feed)
+METEOALARM_MAX_DOCUMENTS = int(os.getenv('METEOALARM_MAX_DOCUMENTS', '300'))
+
+# Feed Atom solo con las entradas cuyo CAP no se descargó (se parsean desde el feed)
+FEED_FALLBACK = 'feed-sin-cap.xml'
+
+# awareness_level de MeteoAlarm ("2; yellow; Moderate") y severidad CAP -> nivel interno
+AWARENESS_LEVELS = {'green': 'verde', 'yellow': 'amarillo', 'orange': 'naranja', 'red': 'rojo'}
+SEVERITY_LEVELS = {'minor': 'verde', 'moderate': 'amarillo', 'severe': 'naranja', 'extreme': 'rojo'}
+
+
+def read_url(url: str, timeout: int = 30) -> bytes:
+    """Lee `url` por HTTP(S) o desde disco (ruta local o `file://`)."""
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        return Path(unquote(parsed.path)).read_bytes()
+    if parsed.scheme not in ('http', 'https'):
+        return Path(url).read_bytes()
+    resp = requests.get(url, timeout=timeout)
+    resp.raise_for_status()
+    return resp.content
+
+
+def _local(tag: str) -> str:
+    """Nombre de etiqueta sin espacio de nombres."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _children(elem, name: str):
+    return [c for c in elem if _local(c.tag) == name]
+
+
+def _child_text(elem, name: str) -> str:
+    for c in elem:
+        if _local(c.tag) == name and c.text:
+            return c.text.strip()
+    return ''
+
+
+def _value_pairs(elem, name: str):
+    """Devuelve {valueName: value} de los hijos `name` (parameter/geocode) de `elem`."""
+    pairs = {}
+    for node in _children(elem, name):
+        key = _child_text(node, 'valueName')
+        if key:
+            pairs[key] = _child_text(node, 'value')
+    return pairs
+
+
+class AlertSource:
+    """Interfaz de una fuente de avisos CAP."""
+
+    name = 'source'
+
+    def download(self, dest_dir: Path):
+        """Descarga los datos raw en `dest_dir`. Devuelve la ruta raw (fichero o carpeta) o None."""
+        raise NotImplementedError
+
+    def extract(self, raw: Path, dest_dir: Path) -> bool:
+        """Deja en `dest_dir` los documentos CAP contenidos en `raw`."""
+        raise NotImplementedError
+
+    def documents(self, dest_dir: Path):
+        """Rutas de los documentos CAP descargados en `dest_dir`."""
+        return find_cap_files(dest_dir)
+
+    def parse(self, text: str):
+        """Genera los avisos de un documento (dicts como `alert_records_from_text`)."""
+        raise NotImplementedError
+
+    def map_area(self, area):
+        """Convierte el elemento XML (ElementTree) de un área de aviso en `(codigo, nombre)` de región.
+
+        `area` es el nodo más concreto que da la fuente: `<area>` en un CAP,
+        `<entry>` en un feed Atom o el nodo del aviso si no hay más detalle.
+        Devuelve `('', '')` si no corresponde a ninguna región.
+        """
+        raise NotImplementedError
+
+
+class AemetSource(AlertSource):
+    """API OpenData de AEMET: JSON con URL `datos` -> paquete tar con CAP por provincia."""
+
+    name = 'aemet'
+
+    def download(self, dest_dir: Path):
+        json_path, datos_url = fetch_aemet_datos_url()
+        if not json_path:
+            print('❌ No se pudo obtener el JSON de AEMET (todas las opciones fallaron)')
+            return None
+        if not datos_url:
+            print('⚠️  El campo "datos" no contiene URL válida')
+            return None
+
+        print(f"📥 Descargando paquete de alertas: {datos_url}")
+        package = download_file(datos_url, json_path.stem, out_dir=dest_dir)
+        if not package:
+            print('❌ Falló la descarga del paquete de alertas')
+            return None
+        # conservar solo el último paquete (y las descargas parciales, para reanudar)
+        for f in dest_dir.iterdir():
+            if f.is_file() and f != package and f.suffix != '.part':
+                f.unlink()
+        return package
+
+    def extract(self, raw: Path, dest_dir: Path) -> bool:
+        return extract_tar(raw, dest_dir)
+
+    def parse(self, text: str):
+        return alert_records_from_text(text, map_area=self.map_area)
+
+    def map_area(self, area):
+        # Los CAP de AEMET no traen geocódigos útiles: la provincia se deduce del texto del nodo
+        return node_province_region(area)
+
+
+class MeteoAlarmSource(AlertSource):
+    """Feed Atom de MeteoAlarm y los documentos CAP que enlaza.
+
+    `regions` permite renombrar códigos EMMA_ID (p.ej. {'PT008': 'Faro'});
+    si no se indica, se usa el `areaDesc` del aviso.
+    """
+
+    def __init__(self, country: str, feed_url: str = None, regions: dict = None):
+        self.country = country.strip().lower()
+        self.name = f'meteoalarm-{self.country}'
+        self.feed_url = feed_url or METEOALARM_FEED_URL.format(country=self.country)
+        self.regions = regions or {}
+
+    def download(self, dest_dir: Path):
+        print(f"📡 Descargando feed MeteoAlarm ({self.country}): {self.feed_url}")
+        raw = read_url(self.feed_url)
+        try:
+            root = ET.fromstring(raw)
+        except ET.ParseError as e:
+            # Sin feed legible la fuente falla y se conserva la descarga anterior
+            raise ValueError(f'feed MeteoAlarm no válido: {e}')
+        # Se descarga en una carpeta aparte y solo sustituye a la anterior al terminar
+        new_dir = dest_dir.with_name(dest_dir.name + '.new')
+        if new_dir.exists():
+            shutil.rmtree(new_dir)
+        (new_dir / 'cap').mkdir(parents=True)
+        (new_dir / 'feed.xml').write_bytes(raw)
+
+        # Las entradas sin CAP descargado (enlace caducado, error, o más de
+        # METEOALARM_MAX_DOCUMENTS) se parsean desde sus propios campos cap:* del feed
+        entries = self.feed_entries(root)
+        fallback = []
+        for idx, (entry, href) in enumerate(entries):
+            if href and idx < METEOALARM_MAX_DOCUMENTS:
+                try:
+                    (new_dir / 'cap' / f'{idx:04d}.xml').write_bytes(read_url(urljoin(self.feed_url, href)))
+                    continue
+                except Exception as e:
+                    print(f'⚠️  No se pudo descargar CAP {href}: {e}; se usa la entrada del feed')
+            fallback.append(entry)
+        if len(entries) > METEOALARM_MAX_DOCUMENTS:
+            print(f'⚠️  {len(entries)} entradas en el feed; las que pasan de {METEOALARM_MAX_DOCUMENTS} se parsean desde el feed, sin descargar su CAP')
+        keep = {id(entry) for entry in fallback}
+        for entry, _ in entries:
+            if id(entry) not in keep:
+                root.remove(entry)
+        ET.ElementTree(root).write(new_dir / FEED_FALLBACK, encoding='utf-8', xml_declaration=True)
+
+        old_dir = dest_dir.with_name(dest_dir.name + '.old')
+        if dest_dir.exists():
+            shutil.rmtree(old_dir, ignore_errors=True)
+            os.replace(dest_dir, old_dir)
+        os.replace(new_dir, dest_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        print(f"✅ Feed MeteoAlarm ({self.country}) guardado: {len(entries)} entradas, {len(entries) - len(fallback)} CAP descargados")
+        return dest_dir
+
+    def extract(self, raw: Path, dest_dir: Path) -> bool:
+        # El feed y los CAP ya son XML sueltos: basta con copiarlos
+        if dest_dir.exists():
+            shutil.rmtree(dest_dir)
+        shutil.copytree(raw, dest_dir)
+        return True
+
+    @staticmethod
+    def feed_entries(root):
+        """`(entry, url_cap)` de cada entrada del feed (url None si no enlaza un CAP)."""
+        entries = []
+        for entry in _children(root, 'entry'):
+            href = next((link.get('href') for link in _children(entry, 'link')
+                         if link.get('href') and 'cap' in (link.get('type') or '')), None)
+            entries.append((entry, href))
+        return entries
+
+    def documents(self, dest_dir: Path):
+        caps = sorted(str(p) for p in (dest_dir / 'cap').glob('*.xml'))
+        fallback = dest_dir / FEED_FALLBACK
+        if fallback.exists():
+            # CAP completos + entradas del feed cuyo CAP no se descargó
+            return caps + [str(fallback)]
+        # Descargas anteriores sin FEED_FALLBACK: los CAP o, si no hay, el feed completo
+        if caps:
+            return caps
+        feed = dest_dir / 'feed.xml'
+        return [str(feed)] if feed.exists() else []
+
+    def parse(self, text: str):
+        try:
+            root = ET.fromstring(text)
+        except ET.ParseError:
+            return
+        if _local(root.tag) == 'feed':
+            # Entradas del feed Atom: los campos cap:* son hijos directos de <entry>
+            for entry in _children(root, 'entry'):
+                yield from self._records(entry, [entry], _child_text(entry, 'updated'))
+        elif _local(root.tag) == 'alert':
+            for info in self._select_infos(_children(root, 'info')):
+                yield from self._records(info, _children(info, 'area'), _child_text(root, 'sent'))
+
+    @staticmethod
+    def _select_infos(infos):
+        # Los CAP de MeteoAlarm repiten cada aviso por idioma: preferir inglés
+        english = [i for i in infos if _child_text(i, 'language').lower().startswith('en')]
+        return english or infos[:1]
+
+    def _records(self, info, areas, sent: str):
+        params = _value_pairs(info, 'parameter')
+        nivel = self.detect_level(params.get('awareness_level', ''), _child_text(info, 'severity'))
+        if nivel == 'verde':
+            return
+        tipo = params.get('awareness_type', '')
+        event = _child_text(info, 'event')
+        # excluir avisos costeros, igual que con AEMET
+        if re.search(r'coastal', f'{tipo} {event}', re.IGNORECASE):
+            return
+        fenomeno = (tipo.split(';')[-1].strip() or event).capitalize()
+        start = _child_text(info, 'onset') or _child_text(info, 'effective') or sent
+        resumen = _child_text(info, 'headline') or _child_text(info, 'description') or event
+
+        for area in areas:
+            codigo, nombre = self.map_area(area)
+            if not codigo:
+                continue
+            yield {
+                'prov': codigo,
+                'nombre': nombre,
+                'subprov': _child_text(area, 'areaDesc') or None,
+                'nivel': nivel,
+                'fenomeno': fenomeno,
+                'start': alert_downloader.extract_start_date(start),
+                'excerpt': ' '.join(f'{resumen} {nombre}'.split())[:300],
+            }
+
+    @staticmethod
+    def detect_level(awareness_level: str, severity: str) -> str:
+        m = re.search(r'(green|yellow|orange|red)', awareness_level or '', re.IGNORECASE)
+        if m:
+            return AWARENESS_LEVELS[m.group(1).lower()]
+        return SEVERITY_LEVELS.get((severity or '').strip().lower(), 'verde')
+
+    def map_area(self, area):
+        geocodes = _value_pairs(area, 'geocode')
+        codigo = geocodes.get('EMMA_ID') or next(iter(geocodes.values()), '')
+        nombre = self.regions.get(codigo) or _child_text(area, 'areaDesc')
+        return codigo, nombre
+
+
+# Valores de `pais` en sedes.csv que se tratan como España (vacío = España, como hasta ahora)
+PAISES_ES = ('', 'ES', 'ESP', 'ESPAÑA', 'ESPANA', 'SPAIN')
+
+
+def site_region(codigo_postal: str, pais: str = '', region: str = ''):
+    """Código de región de una sede para cruzarla con los avisos, o None.
+
+    Misma regla que `regionSede` en src/server.js: la columna `region` manda
+    (p.ej. `PT008` para una sede en Faro); si no, para sedes en España se usan
+    los 2 primeros dígitos del código postal (código de provincia AEMET). El
+    código postal de otros países no se interpreta (31000 Toulouse no es Navarra).
+    """
+    region = (region or '').strip().upper()
+    if region:
+        return region
+    cp = (codigo_postal or '').strip()
+    if (pais or '').strip().upper() in PAISES_ES and len(cp) == 5 and cp.isdigit():
+        return cp[:2]
+    return None
+
+
+def source_by_name(name: str):
+    """Reconstruye una fuente a partir de su nombre (`aemet`, `meteoalarm-<pais>`)."""
+    if name == 'aemet':
+        return AemetSource()
+    if name.startswith('meteoalarm-'):
+        return MeteoAlarmSource(name.split('-', 1)[1])
+    raise ValueError(f'Fuente de avisos desconocida: {name}')
+
+
+def configured_sources(spec: str = None):
+    """Construye las fuentes indicadas en `spec` (por defecto `ALERTAS_SOURCES`)."""
+    sources = []
+    for item in (spec if spec is not None else ALERTAS_SOURCES).split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if item == 'aemet':
+            if not alert_downloader.AEMET_API_KEY:
+                print('❌ AEMET_API_KEY no configurada. Exporta AEMET_API_KEY en el entorno.')
+                continue
+            sources.append(AemetSource())
+        elif item.startswith('meteoalarm:'):
+            sources.append(MeteoAlarmSource(item.split(':', 1)[1]))
+        else:
+            print(f'⚠️  Fuente de avisos desconocida: {item}')
+    return sources
+
+
+def _download_one(source: AlertSource, dest_dir: Path):
+    try:
+        return source.download(dest_dir)
+    except Exception as e:
+        print(f'❌ Error descargando fuente {source.name}: {e}')
+        return None
+
+
+def fetch_sources(sources, work_dir: Path, max_workers: int = None):
+    """Descarga las fuentes en paralelo, cada una en `work_dir/<nombre>`.
+
+    Devuelve la lista `(fuente, ruta_raw)` de las que se descargaron correctamente.
+    """
+    if not sources:
+        return []
+    dirs = [work_dir / s.name for s in sources]
+    with ThreadPoolExecutor(max_workers=max_workers or len(sources)) as ex:
+        results = list(ex.map(_download_one, sources, dirs))
+    return [(s, raw) for s, raw in zip(sources, results) if raw]
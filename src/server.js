@@ -31,12 +31,26 @@ app.get('/', (req, res) => {
   res.sendFile(path.join(__dirname, '../public/index.html'));
 });
 
+// CSV de la generación publicada (data/alertas/current, ver src/downloader/generations.py).
+// El enlace se resuelve una sola vez por lectura: aunque el descargador publique
+// otra generación mientras tanto, se lee un CSV completo y coherente.
+function rutaAlertasLatest() {
+  try {
+    const generacion = fs.realpathSync(path.join(DATA_DIR, 'alertas', 'current'));
+    const csvPath = path.join(generacion, 'alertas-latest.csv');
+    if (fs.existsSync(csvPath)) return csvPath;
+  } catch (e) {
+    // Sin generación publicada todavía: usar la ubicación clásica
+  }
+  return path.join(DATA_DIR, 'alertas-latest.csv');
+}
+
 // Leer alertas del CSV generado por el script Python
 function leerAlertasDesdeCSV() {
   return new Promise((resolve) => {
     const alertas = {};
-    const csvPath = path.join(DATA_DIR, 'alertas-latest.csv');
-    
+    const csvPath = rutaAlertasLatest();
+
     // Si no existe archivo, devolver objeto vacío (sin alertas)
     if (!fs.existsSync(csvPath)) {
       console.log('⚠️  CSV de alertas no encontrado aún:', csvPath);
@@ -67,6 +81,22 @@ function leerAlertasDesdeCSV() {
   });
 }
 
+// Valores de `pais` en sedes.csv que se tratan como España (vacío = España)
+const PAISES_ES = ['', 'ES', 'ESP', 'ESPAÑA', 'ESPANA', 'SPAIN'];
+
+// Código de región de una sede para cruzarla con los avisos (misma regla que
+// site_region en src/downloader/sources.py): la columna `region` manda (p.ej.
+// PT008); si no, en España los 2 primeros dígitos del código postal.
+function regionSede(codigoPostal, pais, region) {
+  const r = (region || '').trim().toUpperCase();
+  if (r) return r;
+  const cp = (codigoPostal || '').trim();
+  if (PAISES_ES.includes((pais || '').trim().toUpperCase()) && /^\d{5}$/.test(cp)) {
+    return cp.substring(0, 2);
+  }
+  return null;
+}
+
 // Leer sedes del CSV
 function leerSedes() {
   return new Promise((resolve, reject) => {
@@ -100,6 +130,8 @@ function leerSedes() {
           latitud: lat,
           longitud: lon,
           provincia: row.provincia || null,
+          pais: row.pais || 'ES',
+          region: regionSede(row.codigo_postal, row.pais, row.region),
           responsable: {
             nombre: row.responsable_nombre || 'No especificado',
             telefono: row.responsable_telefono || 'No disponible',
@@ -124,10 +156,9 @@ app.get('/api/sedes', async (req, res) => {
     const sedes = await leerSedes();
     const alertas = await leerAlertasDesdeCSV();
     
-    // Asociar alertas a cada sede según su código de provincia
+    // Asociar alertas a cada sede según su región (provincia AEMET o EMMA_ID de MeteoAlarm)
     const sedesConAlertas = sedes.map((sede) => {
-      const codigoProvinicia = sede.codigoPostal?.substring(0, 2);
-      const alerta = alertas[codigoProvinicia] || { 
+      const alerta = (sede.region && alertas[sede.region]) || { 
         nombre: sede.provincia,
         nivel: 'verde', 
         fenomeno: null, 
@@ -189,7 +220,7 @@ const server = app.listen(PORT, '0.0.0.0', () => {
   console.log(`✅ Servidor iniciado en http://0.0.0.0:${PORT}`);
   console.log(`📁 Directorio de datos: ${DATA_DIR}`);
   console.log(`🐍 Las alertas son procesadas por el script Python`);
-  console.log(`📊 Lecturas desde: data/alertas-latest.csv`);
+  console.log(`📊 Lecturas desde: data/alertas/current/alertas-latest.csv (o data/alertas-latest.csv)`);
   console.log(`🌍 Entorno: ${process.env.NODE_ENV || 'development'}`);
   console.log('═══════════════════════════════════════════════════════');
 });